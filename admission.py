@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List
+
+from telegram import Update
+from telegram.error import TelegramError
+
+from metrics import Counter, QUEUE_DEPTH, registry, wrap_handlers
+
+logger = logging.getLogger(__name__)
+
+# Per-user token bucket: USER_RATE updates per second, bursts of USER_BURST
+USER_RATE = float(os.getenv('USER_RATE', 1))
+USER_BURST = float(os.getenv('USER_BURST', 5))
+# Updates handled at the same time across all users, and how long an update
+# may wait for a slot before it is dropped
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 64))
+ADMISSION_WAIT = float(os.getenv('ADMISSION_WAIT', 10))
+# A user gets at most one "slow down" reply per this many seconds
+SLOW_DOWN_INTERVAL = float(os.getenv('SLOW_DOWN_INTERVAL', 30))
+SWEEP_INTERVAL = float(os.getenv('ADMISSION_SWEEP_INTERVAL', 60))
+
+REJECTED = registry.register(Counter("bot_admission_rejected_total", "Updates refused by admission control.", ["reason"]))
+
+# Indexes into a table entry
+TOKENS, UPDATED, WARNED = 0, 1, 2
+
+
+class AdmissionControl:
+    # Sits in front of every handler. Each user has a token bucket stored as
+    # a three-float list in one dict; entries idle long enough to have
+    # refilled completely are swept out. A global semaphore caps how many
+    # updates run at once so a burst cannot pile up Mongo and API calls.
+
+    def __init__(self, rate: float = USER_RATE, burst: float = USER_BURST,
+                 max_concurrent: int = MAX_CONCURRENT_UPDATES, wait: float = ADMISSION_WAIT,
+                 exempt=()) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.wait = wait
+        self.exempt = set(exempt)
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._table: Dict[int, List[float]] = {}
+        self._last_sweep = time.monotonic()
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if now - self._last_sweep > SWEEP_INTERVAL:
+            self._sweep(now)
+        entry = self._table.get(user_id)
+        if entry is None:
+            entry = self._table[user_id] = [self.burst, now, 0.0]
+        entry[TOKENS] = min(self.burst, entry[TOKENS] + (now - entry[UPDATED]) * self.rate)
+        entry[UPDATED] = now
+        if entry[TOKENS] >= 1:
+            entry[TOKENS] -= 1
+            return True
+        return False
+
+    def should_warn(self, user_id: int) -> bool:
+        entry = self._table.get(user_id)
+        now = time.monotonic()
+        if entry is None or now - entry[WARNED] < SLOW_DOWN_INTERVAL:
+            return False
+        entry[WARNED] = now
+        return True
+
+    def _sweep(self, now: float) -> None:
+        # An entry that would be full again carries no state worth keeping
+        refill = self.burst / self.rate
+        idle = [user_id for user_id, entry in self._table.items()
+                if now - entry[UPDATED] > refill and now - entry[WARNED] > SLOW_DOWN_INTERVAL]
+        for user_id in idle:
+            del self._table[user_id]
+        self._last_sweep = now
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    async def _slow_down(self, update: Update) -> None:
+        try:
+            if update.callback_query:
+                await update.callback_query.answer("⏳ Slow down, please try again in a few seconds.")
+            elif update.effective_message:
+                await update.effective_message.reply_text("⏳ Slow down, please try again in a few seconds.")
+        except TelegramError as e:
+            logger.info(f"Could not send slow down reply: {e}")
+
+    def guard(self, callback):
+        async def wrapper(update, context):
+            user = update.effective_user if isinstance(update, Update) else None
+            if user and user.id not in self.exempt and not self.allow(user.id):
+                REJECTED.inc(reason="user_rate")
+                if self.should_warn(user.id):
+                    await self._slow_down(update)
+                return None
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.wait)
+            except asyncio.TimeoutError:
+                REJECTED.inc(reason="overloaded")
+                logger.warning("Dropping update, too many updates in flight")
+                return None
+            self.in_flight += 1
+            try:
+                return await callback(update, context)
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+        return wrapper
+
+    def guard_handlers(self, app) -> None:
+        wrap_handlers(app, self.guard)
+        QUEUE_DEPTH.set_function(lambda: self.in_flight, queue="in_flight")
+        QUEUE_DEPTH.set_function(lambda: len(self), queue="admission_table")
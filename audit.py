@@ -0,0 +1,126 @@
+import os
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter, TelegramError
+
+from metrics import Counter, registry
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_ID = os.getenv('CHANNEL_ID')
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 5))  # seconds
+AUDIT_FLUSH_EVENTS = int(os.getenv('AUDIT_FLUSH_EVENTS', 50))
+
+SEPARATOR = "\n\n"
+
+DROPPED = registry.register(Counter("bot_audit_dropped_total", "Audit events dropped because the queue was full."))
+SENT = registry.register(Counter("bot_audit_messages_sent_total", "Audit log messages sent to the channel."))
+
+
+def pack_messages(events: Iterable[str], limit: int = MessageLimit.MAX_TEXT_LENGTH) -> List[str]:
+    # Join events into as few messages as possible without crossing `limit`
+    messages: List[str] = []
+    current = ""
+    for event in events:
+        while len(event) > limit:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(event[:limit])
+            event = event[limit:]
+        if current and len(current) + len(SEPARATOR) + len(event) > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}{SEPARATOR}{event}" if current else event
+    if current:
+        messages.append(current)
+    return messages
+
+
+class AuditLog:
+    # Channel logging off the request path. Handlers call log(), which never
+    # waits; a background task sends digests every `flush_interval` seconds or
+    # `flush_events` events, whichever comes first. When the queue is full new
+    # events are dropped and counted instead of slowing the handlers down.
+
+    def __init__(self, chat_id: Optional[str] = CHANNEL_ID, maxsize: int = AUDIT_QUEUE_SIZE,
+                 flush_interval: float = AUDIT_FLUSH_INTERVAL, flush_events: int = AUDIT_FLUSH_EVENTS) -> None:
+        self.chat_id = chat_id
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.sent = 0
+        self._bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: List[str] = []
+
+    def log(self, text: str) -> None:
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            DROPPED.inc()
+
+    def start(self, bot: Bot) -> None:
+        self._bot = bot
+        if self.chat_id and self._task is None:
+            self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Send whatever is still queued
+        if self._bot is not None and self.chat_id:
+            events, self._pending = self._pending, []
+            await self._send(events + self._drain(self.queue.qsize()))
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self.queue.qsize() + len(self._pending), "sent": self.sent, "dropped": self.dropped}
+
+    def _drain(self, limit: int) -> List[str]:
+        events = []
+        while len(events) < limit and not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+    async def _flusher(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Events being collected live in self._pending so stop() can still send them
+            self._pending = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(self._pending) < self.flush_events:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            events, self._pending = self._pending, []
+            await self._send(events)
+
+    async def _send(self, events: List[str]) -> None:
+        for text in pack_messages(events):
+            for _ in range(3):
+                try:
+                    await self._bot.send_message(chat_id=self.chat_id, text=text)
+                    self.sent += 1
+                    SENT.inc()
+                    break
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except TelegramError as e:
+                    logger.error(f"Failed to send audit log: {e}")
+                    break
+
+
+audit_log = AuditLog()
@@ -0,0 +1,446 @@
+# Offline load test: builds the real Application from main.py and replays
+# synthetic updates against a local Bot API stub, a stub shortener and either
+# a local mongod (--mongo-uri) or an in-memory stand-in (mongomock, from
+# requirements-dev.txt).
+#
+#   python benchmark.py --updates 5000 --users 1000 --output bench_results.json
+#
+# --check-shortener instead runs the shortener client against a scripted
+# stub (retries, timeouts, fallback, circuit breaker) and exits non-zero on
+# a failed check.
+#
+# --workers N (with --mongo-uri) runs N processes of this script with
+# MULTI_WORKER=true against one mongod, all replaying the same updates, and
+# checks that each update is handled once and that no worker is left with a
+# cached user state another worker changed:
+#
+#   python benchmark.py --workers 2 --mongo-uri mongodb://localhost:27017 --updates 2000
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import subprocess
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+BENCH_TOKEN = "123456:BENCHMARK"
+BOT_USERNAME = "bench_bot"
+# How long --workers processes wait for each other's cache events after replaying
+WORKER_SETTLE = 3
+
+
+class BotApiStub(tornado.web.RequestHandler):
+    # Answers every Bot API method with a minimal valid result
+    def initialize(self, latency: float) -> None:
+        self.latency = latency
+
+    async def post(self, method: str) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        method = method.lower()
+        if method == "getme":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME}
+        elif method.startswith("send") or method.startswith("edit") or method == "copymessage":
+            result = {"message_id": 1, "date": int(time.time()), "chat": {"id": 1, "type": "private"}}
+            if method == "sendphoto":
+                result["photo"] = [{"file_id": "bench-photo", "file_unique_id": "bench", "width": 1, "height": 1}]
+        else:
+            result = True
+        self.write({"ok": True, "result": result})
+
+    get = post
+
+
+class ShortenerStub(tornado.web.RequestHandler):
+    def initialize(self, latency: float) -> None:
+        self.latency = latency
+
+    async def get(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.write({"status": "success", "shortenedUrl": f"https://short.example/{random.getrandbits(32):x}"})
+
+
+class ScriptedShortenerStub(tornado.web.RequestHandler):
+    # Answers with the next step of `script`: "ok", an HTTP status code,
+    # "slow" (longer than the client timeout), "delay" (a short wait, then
+    # ok) or "garbage" (not JSON). Once the script is used up every call is ok.
+    def initialize(self, script: List[str], calls: List[str]) -> None:
+        self.script = script
+        self.calls = calls
+
+    async def get(self) -> None:
+        step = self.script.pop(0) if self.script else "ok"
+        self.calls.append(step)
+        if step == "slow":
+            await asyncio.sleep(0.5)
+        elif step == "delay":
+            await asyncio.sleep(0.1)
+        if step == "garbage":
+            self.write("not json")
+        elif step.isdigit():
+            self.set_status(int(step))
+        else:
+            self.write({"status": "success", "shortenedUrl": "https://short.example/ok"})
+
+
+def start_stubs(port: int, api_latency: float, shortener_latency: float) -> HTTPServer:
+    app = tornado.web.Application([
+        (r"/bot[^/]+/(\w+)", BotApiStub, {"latency": api_latency}),
+        (r"/api", ShortenerStub, {"latency": shortener_latency}),
+    ])
+    server = HTTPServer(app)
+    server.listen(port, address="127.0.0.1")
+    return server
+
+
+async def check_shortener(port: int) -> bool:
+    from shortener import CircuitBreaker, Shortener
+
+    script: List[str] = []
+    calls: List[str] = []
+    server = HTTPServer(tornado.web.Application([
+        (r"/api", ScriptedShortenerStub, {"script": script, "calls": calls}),
+    ]))
+    server.listen(port, address="127.0.0.1")
+    client = Shortener(api_url=f"http://127.0.0.1:{port}/api", api_key="check", timeout=0.3, retries=2,
+                       backoff=0.01, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.5))
+    url = "https://example.com/verify"
+    short = "https://short.example/ok"
+    failed = 0
+
+    async def case(name: str, steps: List[str], expected: str, calls_expected: int) -> None:
+        nonlocal failed
+        script[:], calls[:] = steps, []
+        result = await client.shorten(url)
+        ok = result == expected and len(calls) == calls_expected
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name} (got {result}, {len(calls)} calls)")
+
+    try:
+        await case("shortens a url", [], short, 1)
+        await case("retries 5xx and 429 with backoff", ["500", "429"], short, 3)
+        await case("retries after a timeout", ["slow"], short, 2)
+        await case("returns the raw url on a 4xx without retrying", ["400"], url, 1)
+        await case("returns the raw url on invalid JSON", ["garbage"], url, 1)
+        await case("open circuit returns the raw url without a call", [], url, 0)
+        await asyncio.sleep(0.5)
+        # Half-open: of two concurrent callers only one reaches the shortener
+        script[:], calls[:] = ["delay"], []
+        results = await asyncio.gather(client.shorten(url), client.shorten(url))
+        ok = sorted(results) == sorted([short, url]) and len(calls) == 1 and client.breaker.state == "closed"
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} half-open circuit lets one trial through and closes "
+              f"(got {results}, {len(calls)} calls, {client.breaker.state})")
+    finally:
+        await client.close()
+        server.stop()
+    return not failed
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def referral_ids(users: int) -> List[str]:
+    return [f"ref{user_id}" for user_id in range(2, users + 1, 10)]
+
+
+def seed_database(repo, users: int) -> List[str]:
+    # Half the users are verified premium users, the rest have a pending token
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    docs = []
+    sessions = []
+    for user_id in range(1, users + 1):
+        docs.append({"user_id": user_id, "username": f"user{user_id}", "full_name": f"User {user_id}",
+                     "token": f"token{user_id}"})
+        if user_id % 2 == 0:
+            sessions += [{"_id": f"{kind}:{user_id}", "user_id": user_id, "kind": kind,
+                          "expires_at": expires_at, "reminded_by": None} for kind in ("verified", "premium")]
+    repo.users.delete_many({})
+    repo.users.insert_many(docs)
+    repo.sessions.delete_many({})
+    if sessions:
+        repo.sessions.insert_many(sessions)
+    repo.refferals.delete_many({})
+    referrals = [{"refferal_id": refferal_id, "user_id": int(refferal_id[3:]), "reffered_users": []}
+                 for refferal_id in referral_ids(users)]
+    if referrals:
+        repo.refferals.insert_many(referrals)
+    return referral_ids(users)
+
+
+def synthetic_updates(count: int, users: int, referrals: List[str]) -> List[Tuple[str, Dict[str, Any]]]:
+    kinds = ["start", "start_token", "start_terabox", "link", "referral"]
+    weights = [10, 10, 15, 60, 5]
+    updates = []
+    for update_id in range(1, count + 1):
+        kind = random.choices(kinds, weights)[0]
+        user_id = random.randint(1, users)
+        share_id = f"1bench{random.randint(1, 500)}"
+        if kind == "start":
+            text = "/start"
+        elif kind == "start_token":
+            text = f"/start token{user_id}"
+        elif kind == "start_terabox":
+            text = f"/start terabox-{share_id}"
+        elif kind == "link":
+            text = f"https://www.terabox.com/s/{share_id}"
+        else:
+            text = f"/start reffer-{random.choice(referrals or ['none'])}"
+        entities = [{"type": "bot_command", "offset": 0, "length": 6}] if text.startswith("/start") else []
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+        updates.append((kind, {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                "text": text,
+                "entities": entities,
+            },
+        }))
+    return updates
+
+
+async def wait_for_workers(repo, phase: str, workers: int, timeout: float = 120) -> None:
+    # Barrier between the --workers processes, through the shared database
+    from workers import WORKER_ID
+
+    barrier = repo.db["bench_barrier"]
+    await repo._run(barrier.insert_one, {"phase": phase, "worker_id": WORKER_ID})
+    deadline = time.monotonic() + timeout
+    while await repo._run(barrier.count_documents, {"phase": phase}) < workers:
+        if time.monotonic() > deadline:
+            raise SystemExit(f"Timed out waiting for the other workers ({phase})")
+        await asyncio.sleep(0.1)
+
+
+async def stale_user_states(user_state, repo, users: int) -> int:
+    # Cached states that no longer match Mongo, which keeps datetimes to the millisecond
+    stale = 0
+    for user_id in range(1, users + 1):
+        cached = user_state.cache.peek(user_id)
+        if cached is None:
+            continue
+        stored = await repo.get_user_state(user_id)
+        if cached.keys() != stored.keys() or any(
+                abs(cached[key] - stored[key]) >= timedelta(milliseconds=1) for key in cached):
+            stale += 1
+    return stale
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    worker = args.worker_index is not None
+    # Everything is configured through the environment before the bot modules load
+    stub_port = args.stub_port + (args.worker_index or 0)
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    os.environ["SHORTENER_API_URL"] = f"{stub_url}/api"
+    os.environ.setdefault("CHANNEL_ID", "-1000000000000")
+    # Synthetic users send far faster than real ones; keep flood control out of the way
+    os.environ["USER_RATE"] = str(args.user_rate)
+    os.environ["USER_BURST"] = str(args.user_rate)
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        os.environ["MONGO_DB_NAME"] = args.mongo_db
+    if worker:
+        # One of the --workers processes; the parent seeded the database
+        os.environ["MULTI_WORKER"] = "true"
+        os.environ["WORKER_ID"] = f"bench-{args.worker_index}"
+
+    import main
+    from database import repo
+    from metrics import HANDLER_SECONDS, MONGO_SECONDS
+    from telegram import Update
+    from workers import DUPLICATES, INVALIDATIONS
+
+    if args.mongo_uri:
+        repo.connect()
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("The in-memory mode needs mongomock (pip install -r requirements-dev.txt); "
+                             "or pass --mongo-uri to use a local mongod")
+        repo.bind(mongomock.MongoClient())
+
+    stubs = start_stubs(stub_port, args.api_latency / 1000, args.shortener_latency / 1000)
+    referrals = referral_ids(args.users) if worker else seed_database(repo, args.users)
+    random.seed(args.seed)
+    updates = synthetic_updates(args.updates, args.users, referrals)
+
+    app = main.build_application(token=BENCH_TOKEN, base_url=f"{stub_url}/bot")
+    await app.initialize()
+    # Fill the verification token pool up front, so its background refill
+    # does not add Mongo ops to the measured run
+    main.token_pool.bot_username = BOT_USERNAME
+    await main.token_pool.refill()
+    await main.post_init(app)
+    await app.start()
+    if worker:
+        # Cache every user's state up front, so a missed invalidation shows up as a stale entry
+        for user_id in range(1, args.users + 1):
+            await main.user_state.get(user_id)
+        await wait_for_workers(repo, "ready", args.workers)
+
+    latencies: Dict[str, List[float]] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    mongo_ops_before = MONGO_SECONDS.total()
+
+    async def process(kind: str, data: Dict[str, Any]) -> None:
+        async with semaphore:
+            update = Update.de_json(data, app.bot)
+            start = time.perf_counter()
+            await app.process_update(update)
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(process(kind, data) for kind, data in updates))
+    elapsed = time.perf_counter() - started
+    mongo_ops = MONGO_SECONDS.total() - mongo_ops_before
+
+    extra: Dict[str, Any] = {}
+    if worker:
+        # Publish our profile writes, then give every worker's events time to arrive
+        await main.profile_writer.flush()
+        await wait_for_workers(repo, "replayed", args.workers)
+        await asyncio.sleep(WORKER_SETTLE)
+        extra = {
+            "worker": args.worker_index,
+            "duplicates": DUPLICATES.total(),
+            "invalidations": INVALIDATIONS.total(),
+            "stale_user_states": await stale_user_states(main.user_state, repo, args.users),
+        }
+
+    await app.stop()
+    await main.post_stop(app)
+    await app.shutdown()
+    stubs.stop()
+
+    def summary(samples: List[float]) -> Dict[str, float]:
+        return {
+            "count": len(samples),
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+        }
+
+    all_samples = [sample for samples in latencies.values() for sample in samples]
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.utcnow().isoformat(),
+        "config": vars(args),
+        "updates": len(updates),
+        "elapsed_s": elapsed,
+        "updates_per_sec": len(updates) / elapsed if elapsed else 0.0,
+        "mongo_ops_per_update": mongo_ops / len(updates) if updates else 0.0,
+        "handled": HANDLER_SECONDS.total(),
+        "latency": summary(all_samples),
+        "latency_by_kind": {kind: summary(samples) for kind, samples in sorted(latencies.items())},
+        **extra,
+    }
+
+
+def run_workers(args: argparse.Namespace) -> Dict[str, Any]:
+    # Seeds the database, then runs one process per worker on it
+    if not args.mongo_uri:
+        raise SystemExit("--workers needs --mongo-uri: the cache bus tails a capped collection, "
+                         "which the in-memory stand-in does not support")
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["MONGO_DB_NAME"] = args.mongo_db
+    from database import repo
+
+    repo.connect()
+    seed_database(repo, args.users)
+    # Claims from an earlier run would drop every update as a duplicate
+    for name in ("update_claims", "cache_events", "bench_barrier"):
+        repo.db.drop_collection(name)
+
+    outputs = [f"{args.output}.worker{i}" for i in range(args.workers)]
+    processes = [
+        subprocess.Popen([sys.executable, __file__, *sys.argv[1:], "--worker-index", str(i), "--output", output],
+                         stdout=subprocess.DEVNULL)
+        for i, output in enumerate(outputs)
+    ]
+    if any(process.wait() for process in processes):
+        raise SystemExit("A worker failed, see its output above")
+    workers = []
+    for output in outputs:
+        with open(output) as f:
+            workers.append(json.load(f))
+        os.remove(output)
+    claimed = repo.update_claims.count_documents({})
+    repo.close()
+
+    checks = {
+        "every update claimed once": claimed == args.updates,
+        "other workers dropped each update as a duplicate":
+            sum(w["duplicates"] for w in workers) == (args.workers - 1) * args.updates,
+        "every worker received invalidations": all(w["invalidations"] > 0 for w in workers),
+        "no stale cached user state": sum(w["stale_user_states"] for w in workers) == 0,
+    }
+    return {
+        "updates": args.updates,
+        "claimed": claimed,
+        "checks": checks,
+        "workers": workers,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay synthetic updates through the bot")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=1, help="updates processed at the same time")
+    parser.add_argument("--mongo-uri", default=None, help="local mongod, default is an in-memory stand-in")
+    parser.add_argument("--mongo-db", default="terabox_bot_benchmark")
+    parser.add_argument("--api-latency", type=float, default=0, help="Bot API stub latency in ms")
+    parser.add_argument("--shortener-latency", type=float, default=0, help="shortener stub latency in ms")
+    parser.add_argument("--user-rate", type=float, default=1000, help="per-user admission rate")
+    parser.add_argument("--stub-port", type=int, default=18080)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--check-shortener", action="store_true",
+                        help="check the shortener client against a scripted stub instead")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="run this many MULTI_WORKER processes on one mongod and check them")
+    parser.add_argument("--worker-index", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.check_shortener:
+        sys.exit(0 if asyncio.run(check_shortener(args.stub_port)) else 1)
+    if args.workers > 1 and args.worker_index is None:
+        results = run_workers(args)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        for name, ok in results["checks"].items():
+            print(f"{'ok  ' if ok else 'FAIL'} {name}")
+        print(f"Saved to {args.output}")
+        sys.exit(0 if all(results["checks"].values()) else 1)
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    json.dump({key: results[key] for key in ("updates_per_sec", "mongo_ops_per_update", "latency")},
+              sys.stdout, indent=2)
+    print(f"\nSaved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from cache import TTLCache
+from database import repo
+
+logger = logging.getLogger(__name__)
+
+STATS_FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', 10))  # seconds
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', 60))  # seconds
+
+# Counter fields kept in every hour and day bucket
+NEW_USERS = "new_users"
+LINKS = "links"
+TOKENS = "tokens"
+VERIFICATIONS = "verifications"
+REFERRALS = "referrals"
+ACTIVE_USERS = "active_users"
+
+
+def hour_bucket(now: datetime) -> str:
+    return f"hour:{now:%Y%m%d%H}"
+
+
+def day_bucket(now: datetime) -> str:
+    return f"day:{now:%Y%m%d}"
+
+
+class BotStats:
+    # Activity counters kept in per-hour and per-day bucket documents.
+    # Events are counted in memory and flushed with one $inc per bucket every
+    # `flush_interval` seconds, so recording an event never touches Mongo.
+    # /stats reads a handful of bucket documents and caches the result.
+
+    def __init__(self, repo, flush_interval: float = STATS_FLUSH_INTERVAL,
+                 cache_ttl: float = STATS_CACHE_TTL) -> None:
+        self.repo = repo
+        self.flush_interval = flush_interval
+        self.cache = TTLCache(maxsize=1, ttl=cache_ttl)
+        self._pending: Counter = Counter()
+        # Users already counted as active today by this process
+        self._seen_day: Optional[str] = None
+        self._seen: Set[int] = set()
+        self._active_pending: List[Tuple[str, int]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def incr(self, field: str, n: int = 1) -> None:
+        now = datetime.utcnow()
+        self._pending[(hour_bucket(now), field)] += n
+        self._pending[(day_bucket(now), field)] += n
+
+    def mark_active(self, user_id: int) -> None:
+        day = day_bucket(datetime.utcnow())
+        if day != self._seen_day:
+            self._seen_day = day
+            self._seen = set()
+        if user_id not in self._seen:
+            self._seen.add(user_id)
+            self._active_pending.append((day, user_id))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _flusher(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush stats: {e}")
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, Counter()
+        active, self._active_pending = self._active_pending, []
+
+        # Only users not yet recorded today (by any process) count towards DAU
+        by_day: Dict[str, List[int]] = defaultdict(list)
+        for day, user_id in active:
+            by_day[day].append(user_id)
+        try:
+            for day in list(by_day):
+                inserted = await self.repo.record_active_users(day, by_day[day])
+                del by_day[day]
+                if inserted:
+                    pending[(day, ACTIVE_USERS)] += inserted
+
+            updates: Dict[str, Dict[str, int]] = defaultdict(dict)
+            for (bucket, field), n in pending.items():
+                updates[bucket][field] = n
+            if updates:
+                await self.repo.inc_stats(updates)
+        except Exception:
+            # Put back the counts and the days not yet recorded so the next flush retries them
+            self._pending.update(pending)
+            self._active_pending.extend((day, user_id) for day, user_ids in by_day.items() for user_id in user_ids)
+            raise
+
+    async def summary(self) -> Dict[str, Any]:
+        summary = self.cache.get("summary")
+        if summary is not None:
+            return summary
+
+        now = datetime.utcnow()
+        hours = [hour_bucket(now - timedelta(hours=i)) for i in range(24)]
+        today = day_bucket(now)
+        buckets = {doc["_id"]: doc for doc in await self.repo.get_stats_buckets(hours + [today])}
+        day = buckets.get(today, {})
+        links_24h = sum(buckets.get(h, {}).get(LINKS, 0) for h in hours)
+        tokens = day.get(TOKENS, 0)
+        verifications = day.get(VERIFICATIONS, 0)
+
+        summary = {
+            "total_users": await self.repo.estimated_user_count(),
+            "db_stats": await self.repo.db_stats(),
+            "dau": day.get(ACTIVE_USERS, 0),
+            "new_users": day.get(NEW_USERS, 0),
+            "links_last_hour": buckets.get(hours[0], {}).get(LINKS, 0),
+            "links_per_hour": links_24h / 24,
+            "tokens": tokens,
+            "verifications": verifications,
+            "conversion": (verifications / tokens * 100) if tokens else 0.0,
+            "referrals": day.get(REFERRALS, 0),
+        }
+        self.cache.set("summary", summary)
+        return summary
+
+
+bot_stats = BotStats(repo)
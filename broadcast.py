@@ -0,0 +1,210 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application
+
+from database import repo
+from media import send_media
+from profiles import profile_writer
+from ratelimit import TokenBucket
+from workers import MULTI_WORKER, WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+# Broadcast settings (all tunable from environment variables)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 30))  # messages per second, Telegram's global limit
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 20))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 200))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))
+BROADCAST_SEND_ATTEMPTS = int(os.getenv('BROADCAST_SEND_ATTEMPTS', 3))
+# A running job not checkpointed for this long is taken over on startup
+BROADCAST_LEASE = float(os.getenv('BROADCAST_LEASE', 300))
+
+REPORT_HEADINGS = {
+    "running": "📣 Broadcast in progress...",
+    "done": "Broadcast completed!",
+    "failed": "⚠️ Broadcast stopped because of an error. Start a new broadcast to reach the remaining users.",
+}
+
+
+def message_payload(message: Message) -> Dict[str, Any]:
+    # Store what we need to resend the message, so a job can resume even if
+    # the admin deletes the original
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id, "caption": message.caption}
+    if message.video:
+        return {"type": "video", "file_id": message.video.file_id, "caption": message.caption}
+    if message.animation:
+        return {"type": "animation", "file_id": message.animation.file_id, "caption": message.caption}
+    if message.document:
+        return {"type": "document", "file_id": message.document.file_id, "caption": message.caption}
+    return {"type": "text", "text": message.text}
+
+
+async def send_payload(bot: Bot, chat_id: int, payload: Dict[str, Any]) -> None:
+    if payload["type"] == "text":
+        await bot.send_message(chat_id=chat_id, text=payload["text"])
+    else:
+        # The admin's message already carries a file_id, never a url
+        await send_media(bot, chat_id, payload["type"], payload["file_id"], caption=payload.get("caption"))
+
+
+class BroadcastEngine:
+    # Runs broadcast jobs stored in Mongo. Users are read in _id order in
+    # batches, each batch is fanned out to a worker pool that shares one
+    # global token bucket, and the job is checkpointed after every batch so
+    # it can resume after a restart. Each chat gets one message per job and
+    # retries back off for at least a second, which keeps us inside the
+    # per-chat limit as well.
+
+    def __init__(self, repo, rate: float = BROADCAST_RATE, workers: int = BROADCAST_WORKERS,
+                 batch_size: int = BROADCAST_BATCH_SIZE,
+                 progress_interval: float = BROADCAST_PROGRESS_INTERVAL) -> None:
+        self.repo = repo
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._tasks: Dict[Any, asyncio.Task] = {}
+
+    async def start_job(self, app: Application, admin_chat_id: int, message: Message) -> None:
+        total = await self.repo.count_broadcast_targets()
+        status = await app.bot.send_message(chat_id=admin_chat_id, text=f"📣 Broadcast started for {total} users...")
+        job = {
+            "status": "running",
+            "payload": message_payload(message),
+            "admin_chat_id": admin_chat_id,
+            "status_message_id": status.message_id,
+            "total": total,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "last_id": None,
+            "worker_id": WORKER_ID,
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow(),
+        }
+        job["_id"] = await self.repo.create_broadcast_job(job)
+        self._spawn(app.bot, job)
+
+    async def resume_jobs(self, app: Application) -> None:
+        # Claimed one at a time, so with several workers each job resumes once.
+        # A single worker owns every job, so it does not wait for the lease.
+        lease = BROADCAST_LEASE if MULTI_WORKER else 0
+        claimed = []
+        while True:
+            job = await self.repo.claim_broadcast_job(WORKER_ID, lease, claimed)
+            if job is None:
+                break
+            claimed.append(job["_id"])
+            logger.info(f"Resuming broadcast job {job['_id']}")
+            self._spawn(app.bot, job)
+
+    async def stop(self) -> None:
+        # Jobs stay "running" in Mongo and resume from their last checkpoint
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _spawn(self, bot: Bot, job: Dict[str, Any]) -> None:
+        job_id = job["_id"]
+        if job_id in self._tasks:
+            return
+        # Plain asyncio task: Application.create_task tasks are awaited on stop
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, bot: Bot, job: Dict[str, Any]) -> None:
+        counters = {key: job.get(key, 0) for key in ("sent", "blocked", "failed")}
+        last_id = job.get("last_id")
+        last_report = 0.0
+        try:
+            while True:
+                batch = await self.repo.broadcast_batch(last_id, self.batch_size)
+                if not batch:
+                    break
+                queue: asyncio.Queue = asyncio.Queue()
+                for doc in batch:
+                    if 'user_id' in doc:
+                        queue.put_nowait(doc['user_id'])
+                blocked: List[int] = []
+                await asyncio.gather(*[
+                    self._worker(bot, job["payload"], queue, counters, blocked)
+                    for _ in range(min(self.workers, queue.qsize()))
+                ])
+                last_id = batch[-1]["_id"]
+                if blocked:
+                    await self.repo.mark_blocked(blocked)
+                    profile_writer.forget(blocked)
+                await self.repo.checkpoint_broadcast_job(job["_id"], last_id, counters)
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(bot, job, counters)
+            await self.repo.finish_broadcast_job(job["_id"], counters)
+            await self._report(bot, job, counters, state="done")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast job {job['_id']} stopped: {e}")
+            try:
+                await self.repo.fail_broadcast_job(job["_id"], counters, str(e))
+            except Exception as db_error:
+                logger.error(f"Could not mark broadcast job {job['_id']} failed: {db_error}")
+            await self._report(bot, job, counters, state="failed")
+
+    async def _worker(self, bot: Bot, payload: Dict[str, Any], queue: asyncio.Queue,
+                      counters: Dict[str, int], blocked: List[int]) -> None:
+        while not queue.empty():
+            chat_id = queue.get_nowait()
+            result = await self._send(bot, chat_id, payload)
+            counters[result] += 1
+            if result == "blocked":
+                blocked.append(chat_id)
+
+    async def _send(self, bot: Bot, chat_id: int, payload: Dict[str, Any]) -> str:
+        for attempt in range(BROADCAST_SEND_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await send_payload(bot, chat_id, payload)
+                return "sent"
+            except RetryAfter as e:
+                # Flood limit applies to the whole bot, so hold every worker
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                logger.info(f"Broadcast to {chat_id} failed: {e}")
+                return "failed"
+            except NetworkError:
+                await asyncio.sleep(1 + attempt)
+            except TelegramError as e:
+                logger.info(f"Broadcast to {chat_id} failed: {e}")
+                return "failed"
+        return "failed"
+
+    async def _report(self, bot: Bot, job: Dict[str, Any], counters: Dict[str, int],
+                      state: str = "running") -> None:
+        processed = counters["sent"] + counters["blocked"] + counters["failed"]
+        text = (
+            f"{REPORT_HEADINGS[state]}\n\n"
+            f"Total users: {job['total']}\n"
+            f"Processed: {processed}\n"
+            f"Messages sent: {counters['sent']}\n"
+            f"Users blocked the bot: {counters['blocked']}\n"
+            f"Failed to send messages: {counters['failed']}"
+        )
+        try:
+            await bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["status_message_id"])
+        except TelegramError as e:
+            logger.info(f"Could not update broadcast status: {e}")
+
+
+broadcaster = BroadcastEngine(repo)
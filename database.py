@@ -0,0 +1,496 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from metrics import MONGO_ERRORS, MONGO_SECONDS, timed
+
+logger = logging.getLogger(__name__)
+
+# MongoDB connection settings (all tunable from environment variables)
+MONGO_URI = os.getenv('MONGO_URI')
+MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'terabox_bot')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+MONGO_TIMEOUT_MS = int(os.getenv('MONGO_TIMEOUT_MS', 5000))
+# Kinds of session a user can hold; each expires on its own
+VERIFIED = 'verified'
+PREMIUM = 'premium'
+SESSION_FIELDS = {VERIFIED: 'verified_until', PREMIUM: 'premium_until'}
+# How long startup waits for MongoDB, and how many connections it opens up front
+MONGO_STARTUP_TIMEOUT = float(os.getenv('MONGO_STARTUP_TIMEOUT', 30))  # seconds
+MONGO_WARMUP_CONNECTIONS = int(os.getenv('MONGO_WARMUP_CONNECTIONS', 4))
+# One worker thread per pooled connection, so a query never waits for a socket
+MONGO_WORKERS = int(os.getenv('MONGO_WORKERS', MONGO_MAX_POOL_SIZE))
+
+
+class UserRepository:
+    # Async facade over pymongo. Every query runs on a bounded thread pool so
+    # the telegram event loop keeps serving updates while Mongo is busy.
+
+    def __init__(self, uri: Optional[str], db_name: str = MONGO_DB_NAME,
+                 max_pool_size: int = MONGO_MAX_POOL_SIZE,
+                 min_pool_size: int = MONGO_MIN_POOL_SIZE,
+                 timeout_ms: int = MONGO_TIMEOUT_MS,
+                 workers: int = MONGO_WORKERS) -> None:
+        # Nothing connects here; connect() runs from post_init
+        self.uri = uri
+        self.db_name = db_name
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.timeout_ms = timeout_ms
+        self.client = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mongo')
+
+    def connect(self) -> None:
+        # Creates the client on first use; a no-op once bound
+        if self.client is None:
+            self.bind(MongoClient(
+                self.uri,
+                maxPoolSize=self.max_pool_size,
+                minPoolSize=self.min_pool_size,
+                serverSelectionTimeoutMS=self.timeout_ms,
+                connectTimeoutMS=self.timeout_ms,
+                socketTimeoutMS=self.timeout_ms * 2,
+            ))
+
+    async def warm_up(self, timeout: float = MONGO_STARTUP_TIMEOUT,
+                      connections: int = MONGO_WARMUP_CONNECTIONS) -> None:
+        # Pings until Mongo answers or `timeout` passes, then opens
+        # `connections` pooled sockets with concurrent pings so the first
+        # updates do not pay for the handshakes
+        self.connect()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                await self.ping()
+                break
+            except PyMongoError as e:
+                if loop.time() >= deadline:
+                    raise
+                logger.warning(f"MongoDB not reachable yet: {e}")
+                await asyncio.sleep(1)
+        await asyncio.gather(*(self.ping() for _ in range(connections - 1)))
+
+    async def ping(self) -> None:
+        await self._run(self.client.admin.command, 'ping')
+
+    def bind(self, client) -> None:
+        # Point the repository at a client (the benchmark swaps in an in-memory one)
+        self.client = client
+        self.db = self.client[self.db_name]
+        self.users = self.db['users']
+        self.refferals = self.db['refferals']
+        self.broadcast_jobs = self.db['broadcast_jobs']
+        self.stats = self.db['stats']
+        self.active_users = self.db['active_users']
+        self.update_claims = self.db['update_claims']
+        self.cache_events = self.db['cache_events']
+        self.token_pool = self.db['token_pool']
+        self.sessions = self.db['sessions']
+        self.referral_edges = self.db['referral_edges']
+        self.media_assets = self.db['media_assets']
+        self.migrations = self.db['migrations']
+
+    async def _run(self, func, *args, **kwargs) -> Any:
+        # Label latency by "<collection>.<method>" (or the helper's name)
+        collection = getattr(getattr(func, '__self__', None), 'name', None)
+        op = f"{collection}.{func.__name__}" if isinstance(collection, str) else func.__name__.lstrip('_')
+        loop = asyncio.get_running_loop()
+        async with timed(MONGO_SECONDS, MONGO_ERRORS, op=op):
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    # ---- users ----
+
+    async def get_user_state(self, user_id: int) -> Dict[str, Any]:
+        # Live sessions as {"verified_until": ..., "premium_until": ...}. The
+        # TTL monitor only runs once a minute, so expires_at is checked too.
+        def _state():
+            ids = [f"{kind}:{user_id}" for kind in SESSION_FIELDS]
+            cursor = self.sessions.find({"_id": {"$in": ids}, "expires_at": {"$gt": datetime.utcnow()}},
+                                        {"kind": 1, "expires_at": 1})
+            return {SESSION_FIELDS[doc["kind"]]: doc["expires_at"] for doc in cursor}
+        return await self._run(_state)
+
+    async def redeem_user_token(self, user_id: int, token: str) -> Optional[Dict[str, Any]]:
+        # Tokens issued before the token pool lived on the user document.
+        # Cleared in the same update, so like pool tokens they verify once.
+        return await self._run(
+            self.users.find_one_and_update,
+            {"user_id": user_id, "token": token},
+            {"$unset": {"token": ""}}
+        )
+
+    async def upsert_profiles(self, profiles: Dict[int, Tuple[Optional[str], str]]) -> int:
+        # profiles maps user_id to (username, full_name). Returns how many users this created.
+        requests = [
+            # A user who comes back is reachable again for broadcasts
+            UpdateOne({"user_id": user_id},
+                      {"$set": {"username": username, "full_name": full_name, "blocked": False}},
+                      upsert=True)
+            for user_id, (username, full_name) in profiles.items()
+        ]
+        result = await self._run(self.users.bulk_write, requests, ordered=False)
+        return result.upserted_count
+
+    async def estimated_user_count(self) -> int:
+        # From collection metadata, no scan
+        return await self._run(self.users.estimated_document_count)
+
+    async def users_page(self, after: Any = None, before: Any = None,
+                         limit: int = 30) -> Tuple[List[Dict[str, Any]], bool, bool]:
+        # Keyset pagination on _id: one indexed range query per page.
+        # Returns (users in _id order, has_prev, has_next).
+        projection = {"full_name": 1, "username": 1}
+
+        def _page():
+            if before is not None:
+                users = list(self.users.find({"_id": {"$lt": before}}, projection).sort("_id", -1).limit(limit + 1))
+                has_prev = len(users) > limit
+                return list(reversed(users[:limit])), has_prev, True
+            query = {"_id": {"$gt": after}} if after is not None else {}
+            users = list(self.users.find(query, projection).sort("_id", 1).limit(limit + 1))
+            return users[:limit], after is not None, len(users) > limit
+        return await self._run(_page)
+
+    async def export_users(self, consume: Callable[[Iterator[Dict[str, Any]]], Any],
+                           since: Optional[datetime] = None, session_kind: Optional[str] = None,
+                           batch_size: int = 1000) -> Any:
+        # Runs consume(users) on a Mongo worker thread, where users is a
+        # generator over a batched, projected cursor. With session_kind only
+        # users holding a live session of that kind are yielded: sessions are
+        # read in batches and each batch of user_ids is looked up with $in.
+        projection = {"user_id": 1, "username": 1, "full_name": 1, "blocked": 1}
+        query: Dict[str, Any] = {}
+        if since is not None:
+            # _id is an ObjectId created on the first /start, so it doubles as the join time
+            query["_id"] = {"$gte": ObjectId.from_datetime(since)}
+
+        def _users() -> Iterator[Dict[str, Any]]:
+            if session_kind is None:
+                yield from self.users.find(query, projection, batch_size=batch_size)
+                return
+            sessions = self.sessions.find(
+                {"kind": session_kind, "expires_at": {"$gt": datetime.utcnow()}},
+                {"user_id": 1}, batch_size=batch_size
+            )
+            while True:
+                user_ids = [doc["user_id"] for doc in islice(sessions, batch_size)]
+                if not user_ids:
+                    return
+                yield from self.users.find({**query, "user_id": {"$in": user_ids}}, projection)
+
+        def _export():
+            return consume(_users())
+        return await self._run(_export)
+
+    async def mark_blocked(self, user_ids: List[int]) -> None:
+        await self._run(self.users.update_many, {"user_id": {"$in": user_ids}}, {"$set": {"blocked": True}})
+
+    # ---- sessions ----
+
+    async def grant_session(self, user_id: int, kind: str, expires_at: datetime) -> None:
+        # One document per (kind, user), removed by the TTL index once expires_at passes
+        await self._run(
+            self.sessions.update_one,
+            {"_id": f"{kind}:{user_id}"},
+            {"$set": {"user_id": user_id, "kind": kind, "expires_at": expires_at, "reminded_by": None}},
+            upsert=True
+        )
+
+    async def claim_expiring_sessions(self, until: datetime, limit: int, worker_id: str) -> List[Dict[str, Any]]:
+        # Marks up to `limit` sessions expiring before `until` as reminded by
+        # this worker and returns them. The update only matches sessions
+        # nobody claimed yet, so with several workers each reminder goes out once.
+        def _claim():
+            query = {"expires_at": {"$gt": datetime.utcnow(), "$lte": until}, "reminded_by": None}
+            ids = [doc["_id"] for doc in self.sessions.find(query, {"_id": 1}).sort("expires_at", 1).limit(limit)]
+            if not ids:
+                return []
+            self.sessions.update_many({"_id": {"$in": ids}, "reminded_by": None},
+                                      {"$set": {"reminded_by": worker_id}})
+            return list(self.sessions.find({"_id": {"$in": ids}, "reminded_by": worker_id}))
+        return await self._run(_claim)
+
+    async def migrate_sessions(self) -> int:
+        # Moves still valid verified_until / premium_until fields off the user
+        # documents into sessions. Returns the number of users migrated. The
+        # scan is unindexed, so it runs once and then only checks the marker.
+        def _migrate():
+            if self._migrated("sessions"):
+                return 0
+            now = datetime.utcnow()
+            fields = list(SESSION_FIELDS.values())
+            cursor = self.users.find({"$or": [{field: {"$exists": True}} for field in fields]},
+                                     {"user_id": 1, **{field: 1 for field in fields}})
+            migrated = 0
+            for user in cursor:
+                requests = [
+                    UpdateOne({"_id": f"{kind}:{user['user_id']}"},
+                              {"$max": {"expires_at": user[field]},
+                               "$setOnInsert": {"user_id": user["user_id"], "kind": kind, "reminded_by": None}},
+                              upsert=True)
+                    for kind, field in SESSION_FIELDS.items()
+                    if isinstance(user.get(field), datetime) and user[field] > now
+                ]
+                if requests:
+                    self.sessions.bulk_write(requests, ordered=False)
+                self.users.update_one({"_id": user["_id"]}, {"$unset": {field: "" for field in fields}})
+                migrated += 1
+            self._mark_migrated("sessions")
+            return migrated
+        return await self._run(_migrate)
+
+    # ---- refferals ----
+
+    async def get_referral(self, refferal_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self.refferals.find_one, {"refferal_id": refferal_id})
+
+    async def get_referral_by_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._run(self.refferals.find_one, {"user_id": user_id})
+
+    async def get_or_create_referral(self, user_id: int) -> str:
+        # Returns the user's refferal_id, creating the refferal record on first use
+        doc = await self.get_referral_by_user(user_id)
+        if doc is None:
+            try:
+                await self._run(
+                    self.refferals.insert_one,
+                    {"refferal_id": os.urandom(6).hex(), "user_id": user_id, "count": 0}
+                )
+            except DuplicateKeyError:
+                # Created concurrently by another update
+                pass
+            doc = await self.get_referral_by_user(user_id)
+        return doc["refferal_id"]
+
+    async def add_referral(self, referrer_id: int, referred_id: int) -> bool:
+        # One edge per (referrer, referred) pair; False for a repeated referral
+        try:
+            await self._run(
+                self.referral_edges.insert_one,
+                {"referrer_id": referrer_id, "referred_id": referred_id, "created_at": datetime.utcnow()}
+            )
+        except DuplicateKeyError:
+            return False
+        await self._run(self.refferals.update_one, {"user_id": referrer_id}, {"$inc": {"count": 1}})
+        return True
+
+    async def top_referrers(self, limit: int) -> List[Dict[str, Any]]:
+        # Highest counts first (indexed sort), with the referrer's name from users
+        pipeline = [
+            {"$match": {"count": {"$gt": 0}}},
+            {"$sort": {"count": -1}},
+            {"$limit": limit},
+            {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "user_id", "as": "user"}},
+            {"$project": {"_id": 0, "user_id": 1, "count": 1,
+                          "full_name": {"$arrayElemAt": ["$user.full_name", 0]},
+                          "username": {"$arrayElemAt": ["$user.username", 0]}}},
+        ]
+
+        def _top():
+            return list(self.refferals.aggregate(pipeline))
+        return await self._run(_top)
+
+    async def migrate_referrals(self) -> int:
+        # Turns the old reffered_users arrays into edges and counts. Returns
+        # the number of refferal records migrated. Runs once, like migrate_sessions.
+        def _migrate():
+            if self._migrated("referrals"):
+                return 0
+            migrated = 0
+            for doc in self.refferals.find({"count": {"$exists": False}}):
+                referred = set(doc.get("reffered_users", [])) - {doc["user_id"]}
+                if referred:
+                    edges = [{"referrer_id": doc["user_id"], "referred_id": user_id, "created_at": datetime.utcnow()}
+                             for user_id in referred]
+                    try:
+                        self.referral_edges.insert_many(edges, ordered=False)
+                    except BulkWriteError:
+                        pass
+                self.refferals.update_one(
+                    {"_id": doc["_id"]},
+                    {"$set": {"count": self.referral_edges.count_documents({"referrer_id": doc["user_id"]})},
+                     "$unset": {"reffered_users": ""}}
+                )
+                migrated += 1
+            self._mark_migrated("referrals")
+            return migrated
+        return await self._run(_migrate)
+
+    # ---- broadcast jobs ----
+
+    async def count_broadcast_targets(self) -> int:
+        return await self._run(self.users.count_documents, {"blocked": {"$ne": True}})
+
+    async def broadcast_batch(self, after_id: Any, limit: int) -> List[Dict[str, Any]]:
+        query: Dict[str, Any] = {"blocked": {"$ne": True}}
+        if after_id is not None:
+            query["_id"] = {"$gt": after_id}
+
+        def _batch():
+            return list(self.users.find(query, {"user_id": 1}).sort("_id", 1).limit(limit))
+        return await self._run(_batch)
+
+    async def create_broadcast_job(self, job: Dict[str, Any]) -> Any:
+        result = await self._run(self.broadcast_jobs.insert_one, job)
+        return result.inserted_id
+
+    async def claim_broadcast_job(self, worker_id: str, lease_seconds: float,
+                                  exclude: List[Any]) -> Optional[Dict[str, Any]]:
+        # Takes over one running job that is ours (same WORKER_ID after a
+        # restart) or whose owner has not checkpointed within the lease, so
+        # only one worker resumes it
+        return await self._run(
+            self.broadcast_jobs.find_one_and_update,
+            {
+                "_id": {"$nin": exclude},
+                "status": "running",
+                "$or": [
+                    {"worker_id": worker_id},
+                    {"updated_at": {"$lt": datetime.utcnow() - timedelta(seconds=lease_seconds)}},
+                    {"updated_at": {"$exists": False}},
+                ],
+            },
+            {"$set": {"worker_id": worker_id, "updated_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def checkpoint_broadcast_job(self, job_id: Any, last_id: Any, counters: Dict[str, int]) -> None:
+        await self._run(
+            self.broadcast_jobs.update_one,
+            {"_id": job_id},
+            {"$set": {"last_id": last_id, **counters, "updated_at": datetime.utcnow()}}
+        )
+
+    async def finish_broadcast_job(self, job_id: Any, counters: Dict[str, int]) -> None:
+        await self._run(
+            self.broadcast_jobs.update_one,
+            {"_id": job_id},
+            {"$set": {"status": "done", **counters, "finished_at": datetime.utcnow()}}
+        )
+
+    async def fail_broadcast_job(self, job_id: Any, counters: Dict[str, int], error: str) -> None:
+        # "failed" jobs are not claimed again on startup
+        await self._run(
+            self.broadcast_jobs.update_one,
+            {"_id": job_id},
+            {"$set": {"status": "failed", **counters, "error": error, "finished_at": datetime.utcnow()}}
+        )
+
+    # ---- verification token pool ----
+
+    async def claim_pool_token(self, bot_username: str, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._run(
+            self.token_pool.find_one_and_update,
+            {"bot": bot_username, "status": "free"},
+            {"$set": {"status": "assigned", "user_id": user_id, "assigned_at": datetime.utcnow()}},
+            projection={"short_url": 1, "token": 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def add_pool_token(self, bot_username: str, token: str, short_url: str,
+                             user_id: Optional[int] = None) -> None:
+        doc: Dict[str, Any] = {"bot": bot_username, "token": token, "short_url": short_url,
+                               "status": "free", "created_at": datetime.utcnow()}
+        if user_id is not None:
+            doc.update(status="assigned", user_id=user_id, assigned_at=datetime.utcnow())
+        await self._run(self.token_pool.insert_one, doc)
+
+    async def redeem_pool_token(self, user_id: int, token: str) -> bool:
+        result = await self._run(
+            self.token_pool.update_one,
+            {"token": token, "user_id": user_id, "status": "assigned"},
+            {"$set": {"status": "used", "used_at": datetime.utcnow()}}
+        )
+        return result.modified_count == 1
+
+    async def count_free_pool_tokens(self, bot_username: str) -> int:
+        return await self._run(self.token_pool.count_documents, {"bot": bot_username, "status": "free"})
+
+    # ---- multi-worker ----
+
+    async def claim_update(self, update_id: int, worker_id: str) -> bool:
+        # False when another worker (or a previous delivery) already claimed it
+        try:
+            await self._run(
+                self.update_claims.insert_one,
+                {"_id": update_id, "worker_id": worker_id, "claimed_at": datetime.utcnow()}
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def publish_cache_event(self, cache: str, keys: List[Any], worker_id: str) -> None:
+        await self._run(
+            self.cache_events.insert_one,
+            {"cache": cache, "keys": keys, "worker_id": worker_id, "created_at": datetime.utcnow()}
+        )
+
+    # ---- activity stats ----
+
+    async def inc_stats(self, updates: Dict[str, Dict[str, int]]) -> None:
+        # updates maps a bucket id ("hour:2024010112", "day:20240101") to counter increments
+        requests = [UpdateOne({"_id": bucket}, {"$inc": fields}, upsert=True) for bucket, fields in updates.items()]
+        await self._run(self.stats.bulk_write, requests, ordered=False)
+
+    async def get_stats_buckets(self, buckets: List[str]) -> List[Dict[str, Any]]:
+        def _buckets():
+            return list(self.stats.find({"_id": {"$in": buckets}}))
+        return await self._run(_buckets)
+
+    async def record_active_users(self, day: str, user_ids: List[int]) -> int:
+        # Returns how many of user_ids were not yet recorded for this day
+        docs = [{"_id": f"{day}:{user_id}", "created_at": datetime.utcnow()} for user_id in user_ids]
+        try:
+            result = await self._run(self.active_users.insert_many, docs, ordered=False)
+            return len(result.inserted_ids)
+        except BulkWriteError as e:
+            return e.details.get("nInserted", 0)
+
+    # ---- media assets ----
+
+    async def get_media_file_id(self, key: str, source: str) -> Optional[str]:
+        # Only a file_id uploaded from the same source counts
+        doc = await self._run(self.media_assets.find_one, {"_id": key, "source": source}, {"file_id": 1})
+        return doc["file_id"] if doc else None
+
+    async def save_media_file_id(self, key: str, kind: str, source: str, file_id: str) -> None:
+        await self._run(
+            self.media_assets.update_one,
+            {"_id": key},
+            {"$set": {"kind": kind, "source": source, "file_id": file_id, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    # ---- one-off migrations ----
+
+    def _migrated(self, name: str) -> bool:
+        # Called from migration helpers already running on the Mongo pool
+        return self.migrations.find_one({"_id": name}) is not None
+
+    def _mark_migrated(self, name: str) -> None:
+        self.migrations.update_one({"_id": name}, {"$set": {"done_at": datetime.utcnow()}}, upsert=True)
+
+    # ---- misc ----
+
+    async def db_stats(self) -> Dict[str, Any]:
+        return await self._run(self.db.command, "dbstats")
+
+    def close(self) -> None:
+        # Let queries already handed to the pool finish first
+        self._executor.shutdown(wait=True)
+        if self.client is not None:
+            self.client.close()
+
+
+repo = UserRepository(MONGO_URI)
@@ -0,0 +1,93 @@
+import io
+import os
+import csv
+import gzip
+import json
+import logging
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from database import PREMIUM, VERIFIED, repo
+
+logger = logging.getLogger(__name__)
+
+# Exports stay in memory up to this size, then spill to disk
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', 8 * 1024 * 1024))  # bytes
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+# Bot API upload limit
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+FIELDS = ["user_id", "username", "full_name", "joined_at", "blocked"]
+FORMATS = ("csv", "jsonl")
+EXPORT_USAGE = (
+    "Usage: /export [csv|jsonl] [verified|premium] [since=YYYY-MM-DD]\n"
+    "Sends all users as a gzipped file, optionally only verified or premium users, "
+    "or users who joined since a date."
+)
+
+
+class ExportError(ValueError):
+    pass
+
+
+def parse_args(args: List[str]) -> Tuple[str, Optional[str], Optional[datetime]]:
+    # Returns (format, session kind, since)
+    fmt, kind, since = "csv", None, None
+    for arg in args:
+        arg = arg.lower()
+        if arg in FORMATS:
+            fmt = arg
+        elif arg in (VERIFIED, PREMIUM):
+            kind = arg
+        elif arg.startswith("since="):
+            try:
+                since = datetime.strptime(arg[len("since="):], "%Y-%m-%d")
+            except ValueError:
+                raise ExportError(f"Invalid date: {arg[len('since='):]}")
+        else:
+            raise ExportError(f"Unknown option: {arg}")
+    return fmt, kind, since
+
+
+def export_row(user: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "user_id": user.get("user_id"),
+        "username": user.get("username") or "",
+        "full_name": user.get("full_name") or "",
+        "joined_at": user["_id"].generation_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "blocked": bool(user.get("blocked")),
+    }
+
+
+def write_users(users: Iterator[Dict[str, Any]], fileobj, fmt: str) -> int:
+    # Streams users into fileobj as gzipped CSV or JSONL, one row at a time.
+    # Returns the number of users written.
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as compressed:
+        text = io.TextIOWrapper(compressed, encoding="utf-8", newline="")
+        if fmt == "csv":
+            writer = csv.DictWriter(text, fieldnames=FIELDS)
+            writer.writeheader()
+            for user in users:
+                writer.writerow(export_row(user))
+                count += 1
+        else:
+            for user in users:
+                text.write(json.dumps(export_row(user), ensure_ascii=False) + "\n")
+                count += 1
+        text.flush()
+        text.detach()
+    return count
+
+
+async def export_users(fileobj, fmt: str = "csv", kind: Optional[str] = None,
+                       since: Optional[datetime] = None) -> int:
+    return await repo.export_users(
+        lambda users: write_users(users, fileobj, fmt),
+        since=since, session_kind=kind, batch_size=EXPORT_BATCH_SIZE
+    )
+
+
+def spooled_file():
+    return tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
@@ -0,0 +1,55 @@
+import os
+import asyncio
+import logging
+from typing import Any, Dict, Tuple
+
+from cache import TTLCache
+from database import repo
+from shortener import shortener
+
+logger = logging.getLogger(__name__)
+
+# A readiness probe pings Mongo at most once per HEALTH_CHECK_TTL seconds
+HEALTH_CHECK_TTL = float(os.getenv('HEALTH_CHECK_TTL', 5))
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', 2))
+
+
+class Health:
+    # State behind /readyz. The bot is ready once post_init has finished and
+    # only while Mongo answers a ping. Once shutdown starts, PTB stops the
+    # webhook server first, so probes fail to connect rather than see a 503.
+    # An open shortener circuit is reported but does not make the bot
+    # unready, links then fall back to the raw url.
+
+    def __init__(self, repo, shortener, ttl: float = HEALTH_CHECK_TTL,
+                 timeout: float = HEALTH_CHECK_TIMEOUT) -> None:
+        self.repo = repo
+        self.shortener = shortener
+        self.timeout = timeout
+        self.cache = TTLCache(maxsize=1, ttl=ttl)
+        self.started = False
+
+    async def mongo_ok(self) -> bool:
+        ok = self.cache.get("mongo")
+        if ok is None:
+            try:
+                await asyncio.wait_for(self.repo.ping(), self.timeout)
+                ok = True
+            except Exception as e:
+                logger.warning(f"MongoDB health check failed: {e}")
+                ok = False
+            self.cache.set("mongo", ok)
+        return ok
+
+    async def report(self) -> Tuple[bool, Dict[str, Any]]:
+        mongo = self.repo.client is not None and await self.mongo_ok()
+        ready = self.started and mongo
+        return ready, {
+            "ready": ready,
+            "started": self.started,
+            "mongo": "ok" if mongo else "down",
+            "shortener": self.shortener.breaker.state,
+        }
+
+
+health = Health(repo, shortener)
@@ -0,0 +1,121 @@
+import os
+import sys
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Run the query plan check at startup and refuse to start on a COLLSCAN
+MONGO_INDEX_CHECK = os.getenv('MONGO_INDEX_CHECK', 'false').lower() == 'true'
+
+# Every index the bot relies on, per collection. create_indexes is a no-op
+# for indexes that already exist with the same spec, so this is safe to run
+# on every start.
+INDEXES: Dict[str, List[IndexModel]] = {
+    'users': [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("token", ASCENDING)], name="user_id_token"),
+    ],
+    'refferals': [
+        IndexModel([("refferal_id", ASCENDING)], name="refferal_id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        # Leaderboard
+        IndexModel([("count", DESCENDING)], name="count"),
+    ],
+    'referral_edges': [
+        # A user counts once per referrer
+        IndexModel([("referrer_id", ASCENDING), ("referred_id", ASCENDING)], name="referrer_referred_unique", unique=True),
+    ],
+    'active_users': [
+        # Daily activity markers are only needed for the current day
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=2 * 24 * 3600),
+    ],
+    'sessions': [
+        # Verification and premium grants disappear on their own once expired
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+        # Reminder scan: unclaimed sessions by expiry
+        IndexModel([("reminded_by", ASCENDING), ("expires_at", ASCENDING)], name="reminded_by_expires_at"),
+    ],
+    'token_pool': [
+        IndexModel([("bot", ASCENDING), ("status", ASCENDING)], name="bot_status"),
+        IndexModel([("token", ASCENDING)], name="token_unique", unique=True),
+        # Handed out tokens are only useful for a few days; free ones have no assigned_at and stay
+        IndexModel([("assigned_at", ASCENDING)], name="assigned_at_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+    'update_claims': [
+        # Telegram stops retrying an update long before a day has passed
+        IndexModel([("claimed_at", ASCENDING)], name="claimed_at_ttl", expireAfterSeconds=24 * 3600),
+    ],
+    'broadcast_jobs': [
+        IndexModel([("status", ASCENDING)], name="status"),
+    ],
+}
+
+# The queries on the hot path, as (collection, filter)
+HOT_QUERIES: List[Tuple[str, Dict[str, Any]]] = [
+    ('users', {"user_id": 1}),
+    ('users', {"user_id": 1, "token": "token"}),
+    ('refferals', {"refferal_id": "refferal"}),
+    ('refferals', {"user_id": 1}),
+    ('refferals', {"count": {"$gt": 0}}),
+    ('referral_edges', {"referrer_id": 1}),
+    ('sessions', {"_id": {"$in": ["verified:1", "premium:1"]}}),
+    ('sessions', {"reminded_by": None, "expires_at": {"$lte": datetime.utcnow()}}),
+    ('token_pool', {"bot": "bot", "status": "free"}),
+    ('token_pool', {"token": "token", "user_id": 1, "status": "assigned"}),
+]
+
+
+def ensure_indexes(db) -> None:
+    for name, models in INDEXES.items():
+        try:
+            created = db[name].create_indexes(models)
+            logger.info(f"Indexes ready on {name}: {', '.join(created)}")
+        except OperationFailure as e:
+            # Usually duplicate data blocking a unique index; the bot still
+            # works, just slower, so do not refuse to start
+            logger.error(f"Could not create indexes on {name}: {e}")
+
+
+def _stages(plan: Dict[str, Any]):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _stages(child)
+
+
+def check_query_plans(db) -> List[str]:
+    # Returns a description of every hot query whose winning plan is a COLLSCAN
+    failures = []
+    for name, query in HOT_QUERIES:
+        explain = db[name].find(query).explain()
+        plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in _stages(plan):
+            failures.append(f"{name} {query}")
+    return failures
+
+
+def verify_indexes(db) -> bool:
+    failures = check_query_plans(db)
+    for failure in failures:
+        logger.error(f"Query falls back to COLLSCAN: {failure}")
+    if not failures:
+        logger.info("All hot queries use an index")
+    return not failures
+
+
+if __name__ == '__main__':
+    # python indexes.py [--check]
+    from database import repo
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    repo.connect()
+    ensure_indexes(repo.db)
+    if '--check' in sys.argv[1:]:
+        sys.exit(0 if verify_indexes(repo.db) else 1)
@@ -0,0 +1,85 @@
+import os
+import re
+import urllib.parse
+from typing import List, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from cache import TTLCache
+
+LINK_CACHE_SIZE = int(os.getenv('LINK_CACHE_SIZE', 20000))
+LINK_CACHE_TTL = int(os.getenv('LINK_CACHE_TTL', 24 * 3600))
+# Links handled from a single message, anything beyond is ignored
+MAX_LINKS_PER_MESSAGE = int(os.getenv('MAX_LINKS_PER_MESSAGE', 10))
+
+PLAYER_URL = "https://terabox-player-one.vercel.app/?url=https://www.terabox.tech/play.html?url={}"
+SHARE_URL = "https://t.me/share/url?url=https://t.me/TeraBox_OnlineBot?start=terabox-{}"
+
+# Every domain TeraBox serves share links from
+TERABOX_DOMAINS = (
+    "terabox.com", "terabox.app", "terabox.fun", "teraboxapp.com", "teraboxlink.com",
+    "teraboxshare.com", "terasharelink.com", "terafileshare.com", "1024terabox.com",
+    "1024tera.com", "freeterabox.com", "4funbox.com", "4funbox.co", "mirrobox.com",
+    "momerybox.com", "nephobox.com", "tibibox.com", "gibibox.com",
+)
+
+# Share ids as they appear after /s/ (they start with "1") or in ?surl= (without the "1")
+SHARE_ID_RE = re.compile(r"[A-Za-z0-9_-]{4,64}")
+
+LINK_RE = re.compile(
+    r"https?://(?:[a-z0-9-]+\.)*(?:" + "|".join(re.escape(d) for d in TERABOX_DOMAINS) + r")"
+    r"(?::\d+)?/"
+    # Same lengths as SHARE_ID_RE (a surl gains its "1" back), so every
+    # matched id also passes parse_share_id in the Share deep link
+    r"(?:s/(?P<sid>[A-Za-z0-9_-]{4,64})"
+    r"|(?:sharing/link|sharing/embed|wap/share/filelist|share/init|share/filelist)"
+    r"\?(?:[^\s#]*?&)?surl=(?P<surl>[A-Za-z0-9_-]{3,63}))"
+    r"(?![A-Za-z0-9_-])",
+    re.IGNORECASE,
+)
+
+
+def extract_share_ids(text: str) -> List[str]:
+    # Canonical share ids of every TeraBox link in text, in order, without duplicates
+    if "://" not in text:
+        return []
+    share_ids = []
+    for match in LINK_RE.finditer(text):
+        share_id = match.group("sid") or "1" + match.group("surl")
+        if share_id not in share_ids:
+            share_ids.append(share_id)
+            if len(share_ids) >= MAX_LINKS_PER_MESSAGE:
+                break
+    return share_ids
+
+
+def parse_share_id(value: str) -> Optional[str]:
+    # Validates the id from a "/start terabox-<id>" deep link
+    value = value.strip()
+    return value if SHARE_ID_RE.fullmatch(value) else None
+
+
+def canonical_url(share_id: str, domain: str = "terabox.com") -> str:
+    return f"https://{domain}/s/{share_id}"
+
+
+def _build_markup(share_id: str) -> InlineKeyboardMarkup:
+    server1 = PLAYER_URL.format(urllib.parse.quote(canonical_url(share_id), safe=''))
+    server2 = PLAYER_URL.format(urllib.parse.quote(canonical_url(share_id, "terafileshare.com"), safe=''))
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🌐Stream Server 1🌐", url=server1)],
+        [InlineKeyboardButton("🌐Stream Server 2🌐", url=server2)],
+        [InlineKeyboardButton("◀Share▶", url=SHARE_URL.format(share_id))]
+    ])
+
+
+# Markups are immutable, so popular share ids reuse the same object
+markup_cache = TTLCache(LINK_CACHE_SIZE, LINK_CACHE_TTL)
+
+
+def link_markup(share_id: str) -> InlineKeyboardMarkup:
+    markup = markup_cache.get(share_id)
+    if markup is None:
+        markup = _build_markup(share_id)
+        markup_cache.set(share_id, markup)
+    return markup
@@ -1,24 +1,39 @@
 import os
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
-import urllib.parse
-from pymongo import MongoClient
+import html
+from bson import ObjectId
+from pymongo.errors import PyMongoError
 from datetime import datetime, timedelta
-import requests
+from database import PREMIUM, VERIFIED, repo
+from shortener import shortener
+from user_state import user_state
+from broadcast import broadcaster
+from audit import audit_log
+from botstats import bot_stats, LINKS, REFERRALS, TOKENS, VERIFICATIONS
+from links import extract_share_ids, link_markup, markup_cache, parse_share_id
+from metrics import InstrumentedRequest, QUEUE_DEPTH, instrument_handlers, register_cache
+from export import (EXPORT_USAGE, MAX_DOCUMENT_SIZE, ExportError, export_users,
+                    parse_args as parse_export_args, spooled_file)
+from health import health
+from webserver import attach_routes
+from admission import AdmissionControl
+from media import media
+from profiles import profile_writer
+from referrals import DUPLICATE, REFERRED, SELF_REFERRAL, referrals
+from reminders import session_reminders
+from scheduler import UPDATE_PENDING, OrderedApplication
+from token_pool import token_pool
+from workers import attach_workers, start_workers, stop_workers
+from indexes import MONGO_INDEX_CHECK, ensure_indexes, verify_indexes
 
 # Add this at the top of the file
 VERIFICATION_REQUIRED = os.getenv('VERIFICATION_REQUIRED', 'true').lower() == 'true'
 
 admin_ids = [6025969005, 6018060368]
 
-# MongoDB connection
-MONGO_URI = os.getenv('MONGO_URI')  # Get MongoDB URI from environment variables
-client = MongoClient(MONGO_URI)
-db = client['terabox_bot']
-users_collection = db['users']
-refferal_collection = db['refferals']
-
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -30,11 +45,19 @@ logger = logging.getLogger(__name__)
 TOKEN = os.getenv('BOT_TOKEN')
 CHANNEL_ID = os.getenv('CHANNEL_ID')
 WEBHOOK = os.getenv('WEBHOOK')
+# Move verified_until / premium_until off user documents into sessions on
+# start. The scan runs once; later starts only read its completion marker
+MIGRATE_SESSIONS = os.getenv('MIGRATE_SESSIONS', 'true').lower() == 'true'
+# Same for the old reffered_users arrays, which become referral edges (also run once)
+MIGRATE_REFERRALS = os.getenv('MIGRATE_REFERRALS', 'true').lower() == 'true'
+# Upper bound for flushing each background queue on shutdown
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 10))  # seconds
 
 # Define the /start command handler
 async def start(update: Update, context: CallbackContext) -> None:
     logger.info("Received /start command")
     user = update.effective_user
+    bot_stats.mark_active(user.id)
 
     # Check if the start command includes a token (for verification)
     if context.args:
@@ -44,18 +67,13 @@ async def start(update: Update, context: CallbackContext) -> None:
             return
         elif text.startswith("/start reffer-"):
             refferal_id = text.replace("/start reffer-", "")
-            refferal_data = refferal_collection.find_one({"refferal_id": refferal_id})
-            if refferal_data:
-                user_id = update.effective_user.id
-                refferal_collection.update_one(
-                    {"refferal_id": refferal_id},
-                    {"$push": {"reffered_users": user_id}}
-                )
+            outcome, refferer_id = await referrals.record(refferal_id, user.id)
+            if outcome == REFERRED:
+                bot_stats.incr(REFERRALS)
                 await update.message.reply_text(
                     "Congratulations! You have been reffered by a user. You will get 24 hours of premium features for free."
                 )
                 # Send a message to the refferer with a button to activate premium features
-                refferer_id = refferal_data["user_id"]
                 await context.bot.send_message(
                     chat_id=refferer_id,
                     text="You have reffered a new user. You can activate your premium features now.",
@@ -64,19 +82,23 @@ async def start(update: Update, context: CallbackContext) -> None:
                         [InlineKeyboardButton("Do it Later", callback_data="later")]
                     ])
                 )
+            elif outcome == SELF_REFERRAL:
+                await update.message.reply_text("You cannot refer yourself.")
+            elif outcome == DUPLICATE:
+                await update.message.reply_text("You have already been reffered by this user.")
             else:
                 await update.message.reply_text("Invalid refferal link.")
         else:
             token = context.args[0]
-            user_data = users_collection.find_one({"user_id": user.id, "token": token})
+            # Pool tokens are single use; tokens from before the pool live on the user document
+            verified = await token_pool.redeem(user.id, token) or await repo.redeem_user_token(user.id, token)
 
-            if user_data:
+            if verified:
                 # Update the user's verification status
-                users_collection.update_one(
-                    {"user_id": user.id},
-                    {"$set": {"verified_until": datetime.now() + timedelta(days=1)}},
-                    upsert=True
-                )
+                verified_until = datetime.utcnow() + timedelta(days=1)
+                await repo.grant_session(user.id, VERIFIED, verified_until)
+                user_state.update(user.id, verified_until=verified_until)
+                bot_stats.incr(VERIFICATIONS)
                 await update.message.reply_text(
                     "✅ **Verification Successful!**\n\n"
                     "You can now use the bot for the next 24 hours without any ads or restrictions.",
@@ -91,22 +113,21 @@ async def start(update: Update, context: CallbackContext) -> None:
         return
 
     # If no token, send the welcome message and store user ID in MongoDB
-    users_collection.update_one(
-        {"user_id": user.id},
-        {"$set": {"username": user.username, "full_name": user.full_name}},
-        upsert=True
-    )
+    # Written in the background, and only if the name changed
+    profile_writer.save(user.id, user.username, user.full_name)
     message = (
         f"New user started the bot:\n"
         f"Name: {user.full_name}\n"
         f"Username: @{user.username}\n"
         f"User    ID: {user.id}"
     )
-    await context.bot.send_message(chat_id=CHANNEL_ID, text=message)
-    # Corrected photo URL
-    photo_url = 'https://ik.imagekit.io/dvnhxw9vq/unnamed.png?updatedAt=1735280750258'
-    await update.message.reply_photo(
-        photo=photo_url,
+    # Queued for the channel digest, the user does not wait on it
+    audit_log.log(message)
+    # Uploaded from WELCOME_PHOTO_URL once, then sent by file_id
+    await media.send(
+        context.bot,
+        update.effective_chat.id,
+        "welcome",
         caption=(
             "👋 **Welcome to the TeraBox Online Player!** 🌟\n\n"
         "Hello, dear user! I'm here to make your experience seamless and enjoyable.\n\n"
@@ -122,8 +143,8 @@ async def start(update: Update, context: CallbackContext) -> None:
 # Define the /users command handler
 async def users_count(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id in admin_ids:
-        # Count the number of users in the MongoDB collection
-        user_count = users_collection.count_documents({})
+        # Count the number of users in the MongoDB collection (from metadata, no scan)
+        user_count = await repo.estimated_user_count()
         await update.message.reply_text(f"Total users who have interacted with the bot: {user_count}")
     else:
         await update.message.reply_text("You Have No Rights To Use My Commands")
@@ -131,11 +152,12 @@ async def users_count(update: Update, context: CallbackContext) -> None:
 async def stats(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id in admin_ids:
         try:
-            # Get total users
-            total_users = users_collection.count_documents({})
+            # Served from a short-lived cache, built from the hour/day stats buckets
+            summary = await bot_stats.summary()
+            total_users = summary["total_users"]
 
             # Get MongoDB database stats
-            db_stats = db.command("dbstats")
+            db_stats = summary["db_stats"]
 
             # Calculate used storage
             used_storage_mb = db_stats['dataSize'] / (1024 ** 2)  # Convert bytes to MB
@@ -153,12 +175,26 @@ async def stats(update: Update, context: CallbackContext) -> None:
                 total_storage_mb = "N/A"
                 free_storage_mb = free_storage_in_mb
 
+            cache_stats = user_state.stats()
+            audit_stats = audit_log.stats()
+
             # Prepare the response message
             message = (
                 f"📊 **Bot Statistics**\n\n"
                 f"👥 **Total Users:** {total_users}\n"
+                f"🆕 **New Users Today:** {summary['new_users']}\n"
+                f"🙋 **Active Users Today:** {summary['dau']}\n"
+                f"🔗 **Links Last Hour:** {summary['links_last_hour']} "
+                f"(avg {summary['links_per_hour']:.1f}/hour over 24h)\n"
+                f"✅ **Verifications Today:** {summary['verifications']} of {summary['tokens']} tokens "
+                f"({summary['conversion']:.1f}%)\n"
+                f"🤝 **Referrals Today:** {summary['referrals']}\n"
                 f"💾 **MongoDB Used Storage:** {used_storage_mb:.2f} MB\n"
                 f"🆓 **MongoDB Free Storage:** {free_storage_mb if isinstance(free_storage_mb, str) else f'{free_storage_mb:.2f} MB'}\n"
+                f"🗂 **User Cache:** {cache_stats['size']} cached, {cache_stats['hits']} hits, "
+                f"{cache_stats['misses']} misses, {cache_stats['evictions']} evictions\n"
+                f"📝 **Audit Log:** {audit_stats['sent']} messages sent, {audit_stats['dropped']} events dropped, "
+                f"{audit_stats['queued']} queued\n"
             )
 
             await update.message.reply_text(message, parse_mode='Markdown')
@@ -170,6 +206,13 @@ async def stats(update: Update, context: CallbackContext) -> None:
 
 async def handle_link(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
+    bot_stats.mark_active(user.id)
+    # Cheap rejection of anything that is not a TeraBox link, before any DB access
+    share_ids = extract_share_ids(update.message.text)
+    if not share_ids:
+        await update.message.reply_text("Please send Me Only TeraBox Link.")
+        return
+
     # Check if user is admin
     if user.id in admin_ids:
         # Admin ko verify karne ki zaroorat na ho
@@ -196,46 +239,28 @@ async def handle_link(update: Update, context: CallbackContext) -> None:
             return
 
     user_id = update.effective_user.id
-    user_data = users_collection.find_one({"user_id": user_id})
-    if user_data and user_data.get("premium_until", datetime.min) > datetime.now():
+    # Served from the user-state cache, check_verification above already loaded it
+    user_data = await user_state.get(user_id)
+    if user_data.get("premium_until", datetime.min) > datetime.utcnow():
         # User has premium features, proceed with the link handling
-        # Check if user sent a link
-        if update.message.text.startswith('http://') or update.message.text.startswith('https://'):
-            # User sent a link
-            original_link = update.message.text
-            parsed_link = urllib.parse.quote(original_link, safe='')
-            modified_link = f"https://terabox-player-one.vercel.app/?url=https://www.terabox.tech/play.html?url={parsed_link}"
-            modified_url = f"https://terabox-player-one.vercel.app/?url=https://www.terabox.tech/play.html?url={parsed_link}"
-            link_parts = original_link.split('/')
-            link_id = link_parts[-1]
-            sharelink = f"https://t.me/share/url?url=https://t.me/TeraBox_OnlineBot?start=terabox-{link_id}"
-
-            # Create a button with the modified link
-            button = [
-                [InlineKeyboardButton("🌐Stream Server 1🌐", url=modified_link)],
-                [InlineKeyboardButton("🌐Stream Server 2🌐", url=modified_url)],
-                [InlineKeyboardButton("◀Share▶", url=sharelink)]
-            ]
-            reply_markup = InlineKeyboardMarkup(button)
-
-            # Send the user's details and message to the channel
-            user_message = (
-                f"User     message:\n"
-                f"Name: {update.effective_user.full_name}\n"
-                f"Username: @{update.effective_user.username}\n"
-                f"User     ID: {update.effective_user.id}\n"
-                f"Message: {original_link}"
-            )
-            await context.bot.send_message(chat_id=os.getenv('CHANNEL_ID'), text=user_message)
+        # Send the user's details and message to the channel
+        user_message = (
+            f"User     message:\n"
+            f"Name: {update.effective_user.full_name}\n"
+            f"Username: @{update.effective_user.username}\n"
+            f"User     ID: {update.effective_user.id}\n"
+            f"Message: {update.message.text}"
+        )
+        audit_log.log(user_message)
+        bot_stats.incr(LINKS, len(share_ids))
 
-            # Send the message with the link, copyable link, and button
+        # One reply per link in the message, markups come from the per-share-id cache
+        for share_id in share_ids:
             await update.message.reply_text(
                 f"👇👇 YOUR VIDEO LINK IS READY, USE THESE SERVERS 👇👇\n\n♥ 👇Your Stream Link👇 ♥\n",
-                reply_markup=reply_markup,
+                reply_markup=link_markup(share_id),
                 parse_mode='Markdown'
             )
-        else:
-            await update.message.reply_text("Please send Me Only TeraBox Link.")
     else:
         await update.message.reply_text("You need to activate premium features to use this service.")
 
@@ -244,36 +269,8 @@ async def broadcast(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id in admin_ids:
         message = update.message.reply_to_message
         if message:
-            # Fetch all user IDs from MongoDB
-            all_users = users_collection.find({}, {"user_id": 1})
-            total_users = users_collection.count_documents({})
-            sent_count = 0
-            block_count = 0
-            fail_count = 0
-
-            for user_data in all_users:
-                user_id = user_data['user_id']
-                try:
-                    if message.photo:
-                        await context.bot.send_photo(chat_id=user_id, photo=message.photo[-1].file_id, caption=message.caption)
-                    elif message.video:
-                        await context.bot.send_video(chat_id=user_id, video=message.video.file_id, caption=message.caption)
-                    else:
-                        await context.bot.send_message(chat_id=user_id, text=message.text)
-                    sent_count += 1
-                except Exception as e:
-                    if 'blocked' in str(e):
-                        block_count += 1
-                    else:
-                        fail_count += 1
-
-            await update.message.reply_text(
-                f"Broadcast completed!\n\n"
-                f"Total users: {total_users}\n"
-                f"Messages sent: {sent_count}\n"
-                f"Users blocked the bot: {block_count}\n"
-                f"Failed to send messages: {fail_count}"
-            )
+            # Runs in the background, progress is shown by editing a single status message
+            await broadcaster.start_job(context.application, update.effective_chat.id, message)
         else:
             await update.message.reply_text("Please reply to a message with /broadcast to send it to all users.")
     else:
@@ -281,112 +278,104 @@ async def broadcast(update: Update, context: CallbackContext) -> None:
 
 
 async def check_verification(user_id: int) -> bool:
-    user = users_collection.find_one({"user_id": user_id})
-    if user and user.get("verified_until", datetime.min) > datetime.now():
-        return True
-    return False
+    user = await user_state.get(user_id)
+    return user.get("verified_until", datetime.min) > datetime.utcnow()
 
 async def get_token(user_id: int, bot_username: str) -> str:
-    # Generate a random token
-    token = os.urandom(16).hex()
-    # Update user's verification status in database
-    users_collection.update_one(
-        {"user_id": user_id},
-        {"$set": {"token": token, "verified_until": datetime.min}},  # Reset verified_until to min
-        upsert=True
-    )
-    # Create verification link
-    verification_link = f"https://telegram.me/{bot_username}?start={token}"
-    # Shorten verification link using shorten_url_link function
-    shortened_link = shorten_url_link(verification_link)
+    # Claim a pre-shortened token from the pool and bind it to the user
+    # (generated and shortened inline if the pool is empty)
+    shortened_link = await token_pool.issue(user_id, bot_username)
+    bot_stats.incr(TOKENS)
     return shortened_link
 
-def shorten_url_link(url):
-    api_url = 'https://arolinks.com/api'
-    api_key = '90bcb2590cca0a2b438a66e178f5e90fea2dc8b4'
-    params = {
-        'api': api_key,
-        'url': url
-    }
-    # Yahan pe custom certificate bundle ka path specify karo
-    response = requests.get(api_url, params=params, verify=False)
-    if response.status_code == 200:
-        data = response.json()
-        if data['status'] == 'success':
-            logger.info(f"Adrinolinks shortened URL: {data['shortenedUrl']}")
-            return data['shortenedUrl']
-    logger.error(f"Failed to shorten URL with Adrinolinks: {url}")
-    return url
-
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', 30))
+
+def render_users_page(users: list, has_prev: bool, has_next: bool):
+    # One message per page; the buttons carry the _id of the first/last user shown
+    lines = []
+    for user in users:
+        name = html.escape((user.get("full_name") or "N/A")[:40])
+        username = html.escape(user.get("username") or "N/A")
+        lines.append(f"<b>{name}</b> — @{username}")
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀ Prev", callback_data=f"users:prev:{users[0]['_id']}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data=f"users:next:{users[-1]['_id']}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "\n".join(lines), reply_markup
+
 # Define the /userss command handler
 async def userss(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id in admin_ids:
-        # Fetch the first 100 users
-        users = list(users_collection.find({}, {"full_name": 1, "username": 1}).limit(100))
+        # Fetch the first page of users
+        users, has_prev, has_next = await repo.users_page(limit=USERS_PAGE_SIZE)
 
         if not users:
             await update.message.reply_text("No users found in the database.")
             return
 
-        # Prepare the message with user details
-        message = ""
-        for i, user in enumerate(users):
-            name = user.get("full_name", "N/A")
-            username = user.get("username", "N/A")
-            message += f"<b>Name:</b> {name}\n"
-            message += f"<b>Username:</b> @{username}\n\n"
-
-            # Send the message in chunks of 5 users
-            if (i + 1) % 5 == 0:
-                await update.message.reply_text(message, parse_mode='HTML')
-                message = ""
-
-        # Send the remaining users
-        if message:
-            await update.message.reply_text(message, parse_mode='HTML')
-
-        # Display the "Next" button
-        keyboard = [[InlineKeyboardButton("Next", callback_data="next_users")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Click 'Next' to view more users", reply_markup=reply_markup)
+        text, reply_markup = render_users_page(users, has_prev, has_next)
+        await update.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
     else:
         await update.message.reply_text("You Have No Rights To Use My Commands")
 
-async def next_users(update: Update, context: CallbackContext) -> None:
+async def export(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in admin_ids:
+        await update.message.reply_text("You Have No Rights To Use My Commands")
+        return
+    try:
+        fmt, kind, since = parse_export_args(context.args or [])
+    except ExportError as e:
+        await update.message.reply_text(f"{e}\n\n{EXPORT_USAGE}")
+        return
+
+    status = await update.message.reply_text("⏳ Exporting users...")
+    # Written chunk by chunk, so memory stays flat however many users there are
+    with spooled_file() as fileobj:
+        try:
+            count = await export_users(fileobj, fmt, kind, since)
+        except Exception as e:
+            logger.error(f"Error exporting users: {e}")
+            await status.edit_text("❌ An error occurred while exporting users.")
+            return
+        size = fileobj.tell()
+        if size > MAX_DOCUMENT_SIZE:
+            await status.edit_text(f"The export of {count} users is {size / 1024 ** 2:.1f} MB, "
+                                   f"over Telegram's upload limit. Narrow it down with a filter.")
+            return
+        fileobj.seek(0)
+        filename = f"users-{kind or 'all'}-{datetime.utcnow():%Y%m%d-%H%M}.{fmt}.gz"
+        await update.message.reply_document(document=fileobj, filename=filename,
+                                            caption=f"{count} users", read_timeout=120, write_timeout=120)
+    await status.delete()
+
+async def users_page(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
+    if query.from_user.id not in admin_ids:
+        await query.answer("You Have No Rights To Use My Commands")
+        return
     await query.answer()
 
-    # Fetch the next 100 users
-    users = list(users_collection.find({}, {"full_name": 1, "username": 1}).skip(100).limit(100))
+    # callback_data is "users:next:<last _id>" or "users:prev:<first _id>"
+    _, direction, key = query.data.split(":", 2)
+    if not ObjectId.is_valid(key):
+        await query.edit_message_text("This page has expired, send /users again.")
+        return
+    if direction == "prev":
+        users, has_prev, has_next = await repo.users_page(before=ObjectId(key), limit=USERS_PAGE_SIZE)
+    else:
+        users, has_prev, has_next = await repo.users_page(after=ObjectId(key), limit=USERS_PAGE_SIZE)
 
     if not users:
         await query.edit_message_text("No more users found in the database.")
         return
 
-    # Prepare the message with user details
-    message = ""
-    for i, user in enumerate(users):
-        name = user.get("full_name", "N/A")
-        username = user.get("username", "N/A")
-        message += f"<b>Name:</b> {name}\n"
-        message += f"<b>Username:</b> @{username}\n\n"
-
-        # Send the message in chunks of 5 users
-        if (i + 1) % 5 == 0:
-            await query.edit_message_text(message, parse_mode='HTML')
-            message = ""
-
-    # Send the remaining users
-    if message:
-        await query.edit_message_text(message, parse_mode='HTML')
-
-    # Display the "Next" button
-    keyboard = [[InlineKeyboardButton("Next", callback_data="next_users")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Click 'Next' to view more users", reply_markup=reply_markup)
-    
+    text, reply_markup = render_users_page(users, has_prev, has_next)
+    await query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
+
 async def handle_terabox_link(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
 
@@ -416,23 +405,15 @@ async def handle_terabox_link(update: Update, context: CallbackContext) -> None:
 
     text = update.message.text
     if text.startswith("/start terabox-"):
-        link_text = text.replace("/start terabox-", "")
-        link = f"https://terabox.com/s/{link_text}"
-        linkb = f"https://terafileshare.com/s/{link_text}"
-        slink = f"https://terabox-player-one.vercel.app/?url=https://www.terabox.tech/play.html?url={link}"
-        slinkb = f"https://terabox-player-one.vercel.app/?url=https://www.terabox.tech/play.html?url={linkb}"
-        share = f"https://t.me/share/url?url=https://t.me/TeraBox_OnlineBot?start=terabox-{link_text}"
-
-        button = [
-            [InlineKeyboardButton("🌐Stream Server 1🌐", url=slink)],
-            [InlineKeyboardButton("🌐Stream Server 2🌐", url=slinkb)],
-            [InlineKeyboardButton("◀Share▶", url=share)]
-        ]
-        reply_markup = InlineKeyboardMarkup(button)
+        share_id = parse_share_id(text.replace("/start terabox-", ""))
+        if not share_id:
+            await update.message.reply_text("Invalid TeraBox link.")
+            return
+        bot_stats.incr(LINKS)
 
         await update.message.reply_text(
             f"👇👇 YOUR VIDEO LINK IS READY, USE THESE SERVERS 👇👇\n\n♥ 👇Your Stream Link👇 ♥\n",
-            reply_markup=reply_markup,
+            reply_markup=link_markup(share_id),
             parse_mode='Markdown'
         )
 
@@ -440,55 +421,129 @@ async def activate_premium(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    refferal_data = refferal_collection.find_one({"user_id": user_id})
-    if refferal_data:
+    refferal_data = await repo.get_referral_by_user(user_id)
+    if refferal_data and refferal_data.get("count", 0) > 0:
         # Activate premium features for the user
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"premium_until": datetime.now() + timedelta(days=1)}}
-        )
+        premium_until = datetime.utcnow() + timedelta(days=1)
+        await repo.grant_session(user_id, PREMIUM, premium_until)
+        user_state.update(user_id, premium_until=premium_until)
         await query.edit_message_text("Premium features activated for 24 hours.")
     else:
         await query.edit_message_text("You do not have any refferal data.")
 
+async def refer(update: Update, context: CallbackContext) -> None:
+    link = await referrals.link(update.effective_user.id, context.bot.username)
+    await update.message.reply_text(
+        f"Invite your friends with this link:\n{link}\n\n"
+        "Every new user you refer lets you activate 24 hours of premium features."
+    )
+
+async def leaderboard(update: Update, context: CallbackContext) -> None:
+    top = await referrals.leaderboard()
+    if not top:
+        await update.message.reply_text("No referrals yet. Use /refer to get your link.")
+        return
+    lines = ["🏆 <b>Top Referrers</b>\n"]
+    for rank, entry in enumerate(top, start=1):
+        name = html.escape(entry.get("full_name") or str(entry["user_id"]))
+        lines.append(f"{rank}. {name} - {entry['count']}")
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
 async def balance(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    user_data = users_collection.find_one({"user_id": user_id})
-    if user_data:
-        premium_until = user_data.get("premium_until")
-        if premium_until:
-            await update.message.reply_text(f"Your premium features will expire on {premium_until.strftime('%Y-%m-%d %H:%M:%S')}.")
-        else:
-            await update.message.reply_text("You do not have any premium features.")
+    user_data = await user_state.get(user_id)
+    premium_until = user_data.get("premium_until")
+    if premium_until and premium_until > datetime.utcnow():
+        await update.message.reply_text(f"Your premium features will expire on {premium_until.strftime('%Y-%m-%d %H:%M:%S')} UTC.")
     else:
-        await update.message.reply_text("You do not have any account data.")
+        await update.message.reply_text("You do not have any premium features.")
 
 async def active(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    user_data = users_collection.find_one({"user_id": user_id})
-    if user_data:
-        premium_until = user_data.get("premium_until")
-        if premium_until:
-            # Activate premium features for the user
-            users_collection.update_one(
-                {"user_id": user_id},
-                {"$set": {"premium_until": datetime.now() + timedelta(days=1)}}
-            )
-            await update.message.reply_text("Premium features activated for 24 hours.")
-        else:
-            await update.message.reply_text("You do not have any premium features.")
+    user_data = await user_state.get(user_id)
+    # Expired sessions are gone, but premium is only ever granted to users
+    # who reffered someone, so that is what allows renewing it
+    if user_data.get("premium_until") or (await repo.get_referral_by_user(user_id) or {}).get("count", 0) > 0:
+        # Activate premium features for the user
+        premium_until = datetime.utcnow() + timedelta(days=1)
+        await repo.grant_session(user_id, PREMIUM, premium_until)
+        user_state.update(user_id, premium_until=premium_until)
+        await update.message.reply_text("Premium features activated for 24 hours.")
     else:
-        await update.message.reply_text("You do not have any account data.")
+        await update.message.reply_text("You do not have any premium features.")
 
 
         
-def main() -> None:
-    # Get the port from the environment variable or use default
-    port = int(os.environ.get('PORT', 8080))  # Default to port 8080
-    webhook_url = f"{WEBHOOK}{TOKEN}"  # Replace with your server URL
+async def post_init(app) -> None:
+    # Serve /metrics, /healthz and /readyz next to the webhook once the webhook server is listening
+    attach_routes(app)
+    # Connect and warm the pool before anything touches Mongo; startup fails
+    # if Mongo is still unreachable after MONGO_STARTUP_TIMEOUT
+    try:
+        await repo.warm_up()
+    except PyMongoError as e:
+        logger.error(f"MongoDB is unreachable, not starting: {e}")
+        raise
+    # Make sure every query the handlers run is backed by an index
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, ensure_indexes, repo.db)
+    # Not SystemExit: PTB swallows that in post_init and exits with status 0
+    if MONGO_INDEX_CHECK and not await loop.run_in_executor(None, verify_indexes, repo.db):
+        raise RuntimeError("Some queries fall back to a collection scan, see the log above")
+    await start_workers()
+    # Keep pre-shortened verification tokens ready
+    token_pool.start(app.bot.username)
+    # Renewal reminders for sessions about to expire
+    session_reminders.schedule(app)
+    if MIGRATE_SESSIONS:
+        migrated = await repo.migrate_sessions()
+        if migrated:
+            logger.info(f"Moved sessions of {migrated} users to the sessions collection")
+    if MIGRATE_REFERRALS:
+        migrated = await repo.migrate_referrals()
+        if migrated:
+            logger.info(f"Moved {migrated} refferal records to referral edges")
+    # Pick up broadcast jobs interrupted by a restart
+    await broadcaster.resume_jobs(app)
+    # Start the channel log flusher
+    audit_log.start(app.bot)
+    bot_stats.start()
+    profile_writer.start()
+    health.started = True
+
+async def post_stop(app) -> None:
+    # In-flight updates are done by now; flush the background queues,
+    # each bounded so a stuck one cannot hang shutdown
+    for stop in (broadcaster.stop, audit_log.stop, profile_writer.stop, bot_stats.stop, stop_workers,
+                 token_pool.stop):
+        try:
+            await asyncio.wait_for(stop(), SHUTDOWN_TIMEOUT)
+        except Exception as e:
+            logger.error(f"{stop.__qualname__} did not finish cleanly: {e!r}")
+
+async def post_shutdown(app) -> None:
+    # Release pooled connections
+    await shortener.close()
+    repo.close()
 
+def build_application(token: str = TOKEN, base_url: str = None):
     # Create the Application and pass it your bot's token
-    app = ApplicationBuilder().token(TOKEN).build()
+    builder = ApplicationBuilder().token(token)
+    if base_url:
+        # Used by the benchmark to talk to a local Bot API stub
+        builder = builder.base_url(base_url)
+    app = (
+        builder
+        # Times every Bot API call
+        .request(InstrumentedRequest(connection_pool_size=256))
+        # Different users in parallel, each user's updates in order
+        .application_class(OrderedApplication)
+        .concurrent_updates(UPDATE_PENDING)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Register the /start command handler
     app.add_handler(CommandHandler("start", start))
@@ -500,6 +555,10 @@ def main() -> None:
 
     # Register the /userss command handler
     app.add_handler(CommandHandler("users", userss))
+    app.add_handler(CallbackQueryHandler(users_page, pattern=r"^users:(next|prev):"))
+
+    # Register the /export command handler
+    app.add_handler(CommandHandler("export", export))
 
     # Register the /stats command handler
     app.add_handler(CommandHandler("stats", stats))
@@ -513,6 +572,33 @@ def main() -> None:
     # Register the /active command handler
     app.add_handler(CommandHandler("active", active))
 
+    # Referral links, the leaderboard and the referrer's activation button
+    app.add_handler(CommandHandler("refer", refer))
+    app.add_handler(CommandHandler("leaderboard", leaderboard))
+    app.add_handler(CallbackQueryHandler(activate_premium, pattern=r"^activate_premium$"))
+
+
+    # Record latency and errors for every handler registered above
+    instrument_handlers(app)
+    # With MULTI_WORKER=true: drop updates another worker already claimed and
+    # keep the user-state and profile caches consistent across workers
+    attach_workers(app, repo, [("user_state", user_state), ("profiles", profile_writer)])
+    # Per-user flood control and a global cap on updates in flight, admins are exempt
+    AdmissionControl(exempt=admin_ids).guard_handlers(app)
+    QUEUE_DEPTH.set_function(app.update_queue.qsize, queue="updates")
+    QUEUE_DEPTH.set_function(lambda: audit_log.stats()["queued"], queue="audit_log")
+    register_cache("user_state", user_state)
+    register_cache("profiles", profile_writer)
+    QUEUE_DEPTH.set_function(lambda: len(profile_writer), queue="profile_writes")
+    register_cache("link_markup", markup_cache)
+    return app
+
+def main() -> None:
+    # Get the port from the environment variable or use default
+    port = int(os.environ.get('PORT', 8080))  # Default to port 8080
+    webhook_url = f"{WEBHOOK}{TOKEN}"  # Replace with your server URL
+
+    app = build_application()
 
     # Run the bot using a webhook
     app.run_webhook(
@@ -0,0 +1,95 @@
+import os
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+from database import repo
+
+logger = logging.getLogger(__name__)
+
+WELCOME_PHOTO_URL = os.getenv('WELCOME_PHOTO_URL', 'https://ik.imagekit.io/dvnhxw9vq/unnamed.png?updatedAt=1735280750258')
+
+# Bot API method per media kind
+SEND_METHODS = {
+    "photo": "send_photo",
+    "video": "send_video",
+    "animation": "send_animation",
+    "document": "send_document",
+}
+
+
+async def send_media(bot: Bot, chat_id: int, kind: str, media: Any, **kwargs: Any) -> Message:
+    # media is a file_id, a url or a file
+    return await getattr(bot, SEND_METHODS[kind])(chat_id, media, **kwargs)
+
+
+def sent_file_id(message: Message, kind: str) -> str:
+    if kind == "photo":
+        return message.photo[-1].file_id
+    return getattr(message, kind).file_id
+
+
+def is_invalid_file_id(error: BadRequest) -> bool:
+    message = error.message.lower()
+    return "file identifier" in message or "file reference" in message or "file_id" in message
+
+
+class MediaRegistry:
+    # Named media assets (kind and source url) that are uploaded once per
+    # bot. The file_id Telegram returns for the first send is kept in memory
+    # and in the media_assets collection, and every later send reuses it, so
+    # Telegram never fetches the url again. A file_id Telegram rejects is
+    # replaced by uploading from the source again.
+
+    def __init__(self, repo) -> None:
+        self.repo = repo
+        self.assets: Dict[str, Tuple[str, str]] = {}
+        self._file_ids: Dict[str, str] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def register(self, name: str, kind: str, source: str) -> None:
+        self.assets[name] = (kind, source)
+
+    async def send(self, bot: Bot, chat_id: int, name: str, **kwargs: Any) -> Message:
+        kind, source = self.assets[name]
+        # file_ids only work for the bot that received them
+        key = f"{bot.id}:{name}"
+        file_id = await self._file_id(key, source)
+        if file_id is not None:
+            try:
+                return await send_media(bot, chat_id, kind, file_id, **kwargs)
+            except BadRequest as e:
+                if not is_invalid_file_id(e):
+                    raise
+                logger.warning(f"Cached file_id of {name} was rejected, uploading it again: {e}")
+                self._file_ids.pop(key, None)
+        return await self._upload(bot, chat_id, key, kind, source, file_id, **kwargs)
+
+    async def _file_id(self, key: str, source: str) -> Optional[str]:
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            file_id = await self.repo.get_media_file_id(key, source)
+            if file_id is not None:
+                self._file_ids[key] = file_id
+        return file_id
+
+    async def _upload(self, bot: Bot, chat_id: int, key: str, kind: str, source: str,
+                      rejected: Optional[str], **kwargs: Any) -> Message:
+        # One upload per asset at a time; concurrent senders wait and reuse its file_id
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None and file_id != rejected:
+                return await send_media(bot, chat_id, kind, file_id, **kwargs)
+            message = await send_media(bot, chat_id, kind, source, **kwargs)
+            file_id = sent_file_id(message, kind)
+            self._file_ids[key] = file_id
+            await self.repo.save_media_file_id(key, kind, source, file_id)
+            return message
+
+
+media = MediaRegistry(repo)
+media.register("welcome", "photo", WELCOME_PHOTO_URL)
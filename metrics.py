@@ -0,0 +1,183 @@
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from telegram.request import HTTPXRequest
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self) -> float:
+        # Sum across all label values
+        return sum(self._values.values())
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def total(self) -> int:
+        # Observations across all label values
+        return sum(data[-1] for data in self._values.values())
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, data in self._values.items():
+            for bound, count in zip(self.buckets, data):
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {data[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {data[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {data[-1]}"
+
+
+class Gauge:
+    # Values are read from callbacks at scrape time, so queue depths and
+    # cache ratios never need to be pushed
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self._functions[tuple(labels[name] for name in self.labelnames)] = function
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for key, function in self._functions.items():
+            try:
+                value = function()
+            except Exception:
+                continue
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.register(Histogram("bot_handler_seconds", "Handler latency.", ["handler"]))
+HANDLER_ERRORS = registry.register(Counter("bot_handler_errors_total", "Handler exceptions.", ["handler"]))
+MONGO_SECONDS = registry.register(Histogram("bot_mongo_seconds", "MongoDB operation latency.", ["op"]))
+MONGO_ERRORS = registry.register(Counter("bot_mongo_errors_total", "MongoDB operation errors.", ["op"]))
+SHORTENER_SECONDS = registry.register(Histogram("bot_shortener_seconds", "Shortener API request latency."))
+SHORTENER_ERRORS = registry.register(Counter("bot_shortener_errors_total", "Shortener API request errors."))
+TELEGRAM_SECONDS = registry.register(Histogram("bot_telegram_api_seconds", "Bot API call latency.", ["method"]))
+TELEGRAM_ERRORS = registry.register(Counter("bot_telegram_api_errors_total", "Bot API call errors.", ["method"]))
+QUEUE_DEPTH = registry.register(Gauge("bot_queue_depth", "Items waiting in in-process queues.", ["queue"]))
+CACHE_HIT_RATIO = registry.register(Gauge("bot_cache_hit_ratio", "Cache hits / lookups.", ["cache"]))
+CACHE_SIZE = registry.register(Gauge("bot_cache_size", "Entries held in a cache.", ["cache"]))
+
+
+@asynccontextmanager
+async def timed(histogram: Histogram, errors: Counter, **labels: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def instrument_callback(name: str, callback):
+    async def wrapper(update, context):
+        async with timed(HANDLER_SECONDS, HANDLER_ERRORS, handler=name):
+            return await callback(update, context)
+    return wrapper
+
+
+def wrap_handlers(app, decorator) -> None:
+    # Wrap the callback of every handler registered on the application. The
+    # original name is kept, handler metrics are labelled with it.
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+            wrapped = decorator(callback)
+            wrapped.__name__ = getattr(callback, "__name__", "handler")
+            handler.callback = wrapped
+
+
+def instrument_handlers(app) -> None:
+    wrap_handlers(app, lambda callback: instrument_callback(callback.__name__, callback))
+
+
+def register_cache(name: str, cache) -> None:
+    # cache is anything with a stats() dict holding hits, misses and size
+    def ratio():
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        return stats["hits"] / lookups if lookups else 0.0
+    CACHE_HIT_RATIO.set_function(ratio, cache=name)
+    CACHE_SIZE.set_function(lambda: cache.stats()["size"], cache=name)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    # Times every Bot API call by method name (the last part of the url)
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        async with timed(TELEGRAM_SECONDS, TELEGRAM_ERRORS, method=api_method):
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(method=api_method)
+        return code, payload
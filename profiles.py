@@ -0,0 +1,114 @@
+import os
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from botstats import NEW_USERS, bot_stats
+from cache import TTLCache
+from database import repo
+
+logger = logging.getLogger(__name__)
+
+# A changed profile reaches Mongo at most this many seconds later
+PROFILE_FLUSH_INTERVAL = float(os.getenv('PROFILE_FLUSH_INTERVAL', 5))
+# Flush early once this many profiles are waiting
+PROFILE_BATCH_SIZE = int(os.getenv('PROFILE_BATCH_SIZE', 500))
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', 100000))
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 3600))
+
+Profile = Tuple[Optional[str], str]
+
+
+class ProfileWriter:
+    # Write-behind for the username / full_name upsert done on every /start.
+    # The last profile written per user is cached, so an unchanged profile
+    # costs nothing; changed ones are coalesced per user and flushed with
+    # one unordered bulk_write every `flush_interval` seconds. Only
+    # profiles go through here, tokens and sessions are written directly.
+    # Every flush or forget announces its users to `listeners` in one call,
+    # so with several workers the others drop their cached profiles too.
+
+    def __init__(self, repo, flush_interval: float = PROFILE_FLUSH_INTERVAL,
+                 batch_size: int = PROFILE_BATCH_SIZE) -> None:
+        self.repo = repo
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.written = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+        self._pending: Dict[int, Profile] = {}
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Called with the user_ids of each flushed or forgotten batch
+        self.listeners: List[Callable[[List[int]], None]] = []
+
+    def save(self, user_id: int, username: Optional[str], full_name: str) -> None:
+        profile = (username, full_name)
+        if self.written.get(user_id) == profile:
+            return
+        self.written.set(user_id, profile)
+        self._pending[user_id] = profile
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    def forget(self, user_ids: Iterable[int]) -> None:
+        # For users whose document changed behind our back (marked blocked),
+        # so their next /start is written again and unblocks them
+        user_ids = list(user_ids)
+        for user_id in user_ids:
+            self.written.pop(user_id)
+        if user_ids:
+            self._notify(user_ids)
+
+    def invalidate(self, user_id: int, publish: bool = True) -> None:
+        self.written.pop(user_id)
+        if publish:
+            self._notify([user_id])
+
+    def _notify(self, user_ids: List[int]) -> None:
+        for listener in self.listeners:
+            listener(user_ids)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _flusher(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush profiles: {e}")
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            created = await self.repo.upsert_profiles(pending)
+        except Exception:
+            # Keep newer saves made while flushing, retry the rest next time
+            self._pending = {**pending, **self._pending}
+            raise
+        if created:
+            bot_stats.incr(NEW_USERS, created)
+        self._notify(list(pending))
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> Dict[str, int]:
+        return self.written.stats()
+
+
+profile_writer = ProfileWriter(repo)
@@ -0,0 +1,33 @@
+import time
+import asyncio
+
+
+class TokenBucket:
+    # Classic token bucket: `rate` tokens per second, bursts up to `capacity`.
+    # acquire() waits until a token is available.
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        # Drain the bucket so nobody gets a token for `seconds` (used for RetryAfter)
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
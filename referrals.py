@@ -0,0 +1,59 @@
+import os
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import TTLCache
+from database import repo
+
+logger = logging.getLogger(__name__)
+
+REFERRAL_LEADERBOARD_SIZE = int(os.getenv('REFERRAL_LEADERBOARD_SIZE', 10))
+REFERRAL_LEADERBOARD_TTL = float(os.getenv('REFERRAL_LEADERBOARD_TTL', 300))  # seconds
+
+# Outcomes of record()
+REFERRED = "referred"
+INVALID = "invalid"
+SELF_REFERRAL = "self"
+DUPLICATE = "duplicate"
+
+
+def referral_link(bot_username: str, refferal_id: str) -> str:
+    return f"https://telegram.me/{bot_username}?start=reffer-{refferal_id}"
+
+
+class Referrals:
+    # Referral links and edges. Every referral is one document in
+    # referral_edges (unique per referrer and referred user) and bumps a
+    # count on the referrer's refferal record. The leaderboard is an indexed
+    # aggregation over those counts, rebuilt at most once per `ttl` seconds.
+
+    def __init__(self, repo, size: int = REFERRAL_LEADERBOARD_SIZE,
+                 ttl: float = REFERRAL_LEADERBOARD_TTL) -> None:
+        self.repo = repo
+        self.size = size
+        self.cache = TTLCache(maxsize=1, ttl=ttl)
+
+    async def link(self, user_id: int, bot_username: str) -> str:
+        return referral_link(bot_username, await self.repo.get_or_create_referral(user_id))
+
+    async def record(self, refferal_id: str, user_id: int) -> Tuple[str, Optional[int]]:
+        # Returns (outcome, referrer user_id)
+        refferal_data = await self.repo.get_referral(refferal_id)
+        if not refferal_data:
+            return INVALID, None
+        referrer_id = refferal_data["user_id"]
+        if referrer_id == user_id:
+            return SELF_REFERRAL, referrer_id
+        if not await self.repo.add_referral(referrer_id, user_id):
+            return DUPLICATE, referrer_id
+        return REFERRED, referrer_id
+
+    async def leaderboard(self) -> List[Dict[str, Any]]:
+        top = self.cache.get("top")
+        if top is None:
+            top = await self.repo.top_referrers(self.size)
+            self.cache.set("top", top)
+        return top
+
+
+referrals = Referrals(repo)
@@ -0,0 +1,99 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from telegram.ext import CallbackContext
+
+from broadcast import broadcaster
+from database import PREMIUM, VERIFIED, repo
+from profiles import profile_writer
+from workers import WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+# Remind users this long before a session expires
+REMINDER_BEFORE = float(os.getenv('REMINDER_BEFORE', 3600))  # seconds
+REMINDER_INTERVAL = float(os.getenv('REMINDER_INTERVAL', 300))  # seconds between scans
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', 200))
+
+REMINDER_TEXTS = {
+    VERIFIED: "⏳ Your access token expires in less than {within}. Send me a TeraBox link after that to get a new one.",
+    PREMIUM: "⏳ Your premium features expire in less than {within}. Use /active to renew them.",
+}
+
+
+def format_duration(seconds: float) -> str:
+    # 3600 -> "an hour", 5400 -> "90 minutes", 7200 -> "2 hours"
+    for unit, size in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= size and seconds % size == 0:
+            count = int(seconds // size)
+            if count == 1:
+                return f"{'an' if unit == 'hour' else 'a'} {unit}"
+            return f"{count} {unit}s"
+    return f"{max(1, round(seconds / 60))} minutes" if seconds >= 90 else "a minute"
+
+
+class SessionReminders:
+    # JobQueue job that tells users their verification or premium session is
+    # about to expire. Sessions are claimed in batches so each reminder goes
+    # out once across workers, and sends share the broadcast token bucket
+    # since both count against the bot's global message limit.
+
+    def __init__(self, repo, bucket, before: float = REMINDER_BEFORE,
+                 batch_size: int = REMINDER_BATCH_SIZE) -> None:
+        self.repo = repo
+        self.bucket = bucket
+        self.before = before
+        self.batch_size = batch_size
+        within = format_duration(before)
+        self.texts = {kind: text.format(within=within) for kind, text in REMINDER_TEXTS.items()}
+
+    def schedule(self, app, interval: float = REMINDER_INTERVAL) -> None:
+        if app.job_queue is None:
+            logger.warning('Session reminders disabled, install python-telegram-bot[job-queue]')
+            return
+        app.job_queue.run_repeating(self.run, interval=interval, first=interval, name='session_reminders')
+
+    async def run(self, context: CallbackContext) -> None:
+        until = datetime.utcnow() + timedelta(seconds=self.before)
+        while True:
+            sessions = await self.repo.claim_expiring_sessions(until, self.batch_size, WORKER_ID)
+            if not sessions:
+                break
+            counters = {"sent": 0, "blocked": 0, "failed": 0}
+            blocked: List[int] = []
+            for session in sessions:
+                result = await self._send(context.bot, session)
+                counters[result] += 1
+                if result == "blocked":
+                    blocked.append(session["user_id"])
+            if blocked:
+                await self.repo.mark_blocked(blocked)
+                profile_writer.forget(blocked)
+            logger.info(f"Session reminders: {counters['sent']} sent, {counters['blocked']} blocked, "
+                        f"{counters['failed']} failed")
+            if len(sessions) < self.batch_size:
+                break
+
+    async def _send(self, bot, session: Dict[str, Any]) -> str:
+        # "sent", "blocked" or "failed", like BroadcastEngine._send
+        for _ in range(2):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=session["user_id"], text=self.texts[session["kind"]])
+                return "sent"
+            except RetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                return "blocked"
+            except TelegramError as e:
+                logger.info(f"Reminder to {session['user_id']} failed: {e}")
+                return "failed"
+        return "failed"
+
+
+session_reminders = SessionReminders(repo, broadcaster.bucket)
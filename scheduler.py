@@ -0,0 +1,75 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Updates accepted from the update queue, including those waiting behind an
+# earlier update of the same user
+UPDATE_PENDING = int(os.getenv('UPDATE_PENDING', 1024))
+
+# Indexes into a key entry
+LOCK, WAITING = 0, 1
+
+
+def update_key(update: object) -> Optional[Hashable]:
+    # Updates of one user (or of one chat, for channel posts) share a key
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class ChatScheduler:
+    # Runs updates with the same key strictly one after another in arrival
+    # order; asyncio.Lock wakes waiters first in, first out. Updates with
+    # different keys run concurrently. The global cap is AdmissionControl's
+    # semaphore, which handlers only reach once they hold their key, so one
+    # busy user cannot fill every slot and overload still sheds updates
+    # after ADMISSION_WAIT. Keys are dropped when nothing waits on them.
+
+    def __init__(self) -> None:
+        self._keys: Dict[Hashable, List[Any]] = {}
+
+    async def run(self, key: Optional[Hashable], function: Callable[..., Awaitable], *args) -> Any:
+        if key is None:
+            return await function(*args)
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = [asyncio.Lock(), 0]
+        entry[WAITING] += 1
+        try:
+            async with entry[LOCK]:
+                return await function(*args)
+        finally:
+            entry[WAITING] -= 1
+            if not entry[WAITING]:
+                del self._keys[key]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class OrderedApplication(Application):
+    # PTB 20.3 has no pluggable update processor, so updates are routed
+    # through the scheduler here. Build with concurrent_updates(UPDATE_PENDING)
+    # so the update fetcher hands over updates without waiting.
+
+    __slots__ = ("scheduler",)
+
+    def __init__(self, *, scheduler: Optional[ChatScheduler] = None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.scheduler = scheduler or ChatScheduler()
+        QUEUE_DEPTH.set_function(lambda: len(self.scheduler), queue="update_keys")
+
+    async def process_update(self, update: object) -> None:
+        await self.scheduler.run(update_key(update), super().process_update, update)
@@ -0,0 +1,161 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+import httpx
+
+from metrics import SHORTENER_ERRORS, SHORTENER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Shortener settings (all tunable from environment variables)
+SHORTENER_API_URL = os.getenv('SHORTENER_API_URL', 'https://arolinks.com/api')
+SHORTENER_API_KEY = os.getenv('SHORTENER_API_KEY', '90bcb2590cca0a2b438a66e178f5e90fea2dc8b4')
+SHORTENER_TIMEOUT = float(os.getenv('SHORTENER_TIMEOUT', 5))
+SHORTENER_RETRIES = int(os.getenv('SHORTENER_RETRIES', 2))
+SHORTENER_BACKOFF = float(os.getenv('SHORTENER_BACKOFF', 0.3))
+SHORTENER_MAX_CONNECTIONS = int(os.getenv('SHORTENER_MAX_CONNECTIONS', 20))
+# Path to a custom certificate bundle, if the shortener needs one
+SHORTENER_CA_BUNDLE = os.getenv('SHORTENER_CA_BUNDLE')
+BREAKER_FAILURES = int(os.getenv('SHORTENER_BREAKER_FAILURES', 5))
+BREAKER_RESET = float(os.getenv('SHORTENER_BREAKER_RESET', 30))
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures. While open every
+    # call is refused until `reset_timeout` passes, then one trial call is let
+    # through (half-open) to decide whether to close again. Other callers are
+    # refused while the trial runs; a trial that never reports back (e.g.
+    # cancelled) gives way to a new one after another `reset_timeout`.
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_started_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open":
+            return False
+        now = time.monotonic()
+        if self.trial_started_at is not None and now - self.trial_started_at < self.reset_timeout:
+            return False
+        self.trial_started_at = now
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                logger.warning("Shortener circuit opened")
+            self.opened_at = time.monotonic()
+        self.trial_started_at = None
+
+
+class ShortenerError(Exception):
+    pass
+
+
+class Shortener:
+    # Async arolinks client with a pooled connection, strict timeouts, retry
+    # with exponential backoff and a circuit breaker. On any failure the
+    # original url is returned so the user still gets a working link.
+    # Nothing is cached: every url we shorten carries a fresh token.
+
+    def __init__(self, api_url: str = SHORTENER_API_URL, api_key: str = SHORTENER_API_KEY,
+                 timeout: float = SHORTENER_TIMEOUT, retries: int = SHORTENER_RETRIES,
+                 backoff: float = SHORTENER_BACKOFF,
+                 max_connections: int = SHORTENER_MAX_CONNECTIONS,
+                 breaker: Optional[CircuitBreaker] = None) -> None:
+        self.api_url = api_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.breaker = breaker or CircuitBreaker()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                verify=SHORTENER_CA_BUNDLE or True,
+            )
+        return self._client
+
+    async def shorten(self, url: str) -> str:
+        if not self.breaker.allow():
+            logger.warning(f"Shortener circuit open, returning raw URL: {url}")
+            return url
+
+        try:
+            shortened = await self._request(url)
+        except ShortenerError as e:
+            self.breaker.record_failure()
+            logger.error(f"Failed to shorten URL with Arolinks: {url} ({e})")
+            return url
+
+        self.breaker.record_success()
+        logger.info(f"Arolinks shortened URL: {shortened}")
+        return shortened
+
+    async def _request(self, url: str) -> str:
+        params = {'api': self.api_key, 'url': url}
+        last_error: Optional[Exception] = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+            start = time.perf_counter()
+            try:
+                response = await self.client.get(self.api_url, params=params)
+            except httpx.HTTPError as e:
+                SHORTENER_ERRORS.inc()
+                last_error = e
+                continue
+            finally:
+                SHORTENER_SECONDS.observe(time.perf_counter() - start)
+            if response.status_code != 200:
+                SHORTENER_ERRORS.inc()
+                if response.status_code >= 500 or response.status_code == 429:
+                    last_error = ShortenerError(f"HTTP {response.status_code}")
+                    continue
+                raise ShortenerError(f"HTTP {response.status_code}")
+            try:
+                data = response.json()
+            except ValueError as e:
+                raise ShortenerError(f"Invalid JSON: {e}")
+            if data.get('status') == 'success' and data.get('shortenedUrl'):
+                return data['shortenedUrl']
+            raise ShortenerError(f"API error: {data}")
+        raise ShortenerError(str(last_error))
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+shortener = Shortener()
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import logging
+from typing import Optional
+
+from database import repo
+from shortener import shortener
+
+logger = logging.getLogger(__name__)
+
+# Free tokens kept ready; a refill starts when the pool drops under the low watermark
+TOKEN_POOL_TARGET = int(os.getenv('TOKEN_POOL_TARGET', 500))
+TOKEN_POOL_LOW_WATERMARK = int(os.getenv('TOKEN_POOL_LOW_WATERMARK', 100))
+TOKEN_POOL_REFILL_INTERVAL = float(os.getenv('TOKEN_POOL_REFILL_INTERVAL', 60))  # seconds
+TOKEN_POOL_CONCURRENCY = int(os.getenv('TOKEN_POOL_CONCURRENCY', 5))  # parallel shortener calls
+
+
+def verification_link(bot_username: str, token: str) -> str:
+    return f"https://telegram.me/{bot_username}?start={token}"
+
+
+class TokenPool:
+    # Verification tokens whose links are shortened ahead of time. Handing
+    # one out is a single find_one_and_update; the shortener only runs in
+    # the background refill, or inline when the pool is empty.
+
+    def __init__(self, repo, shortener, target: int = TOKEN_POOL_TARGET,
+                 low_watermark: int = TOKEN_POOL_LOW_WATERMARK,
+                 interval: float = TOKEN_POOL_REFILL_INTERVAL) -> None:
+        self.repo = repo
+        self.shortener = shortener
+        self.target = target
+        self.low_watermark = low_watermark
+        self.interval = interval
+        self.bot_username: Optional[str] = None
+        # Free tokens as of the last count, minus our own claims since then
+        self.free_estimate = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def issue(self, user_id: int, bot_username: str) -> str:
+        # Returns the shortened verification link of a token bound to user_id
+        entry = await self.repo.claim_pool_token(bot_username, user_id)
+        if entry is not None:
+            # Only wake the refill when it probably has work to do, so a
+            # claim stays a single Mongo op
+            self.free_estimate -= 1
+            if self.free_estimate < self.low_watermark:
+                self._wakeup.set()
+            return entry["short_url"]
+        # Pool is empty, fall back to generating one inline
+        self.free_estimate = 0
+        self._wakeup.set()
+        token = os.urandom(16).hex()
+        short_url = await self.shortener.shorten(verification_link(bot_username, token))
+        await self.repo.add_pool_token(bot_username, token, short_url, user_id=user_id)
+        return short_url
+
+    async def redeem(self, user_id: int, token: str) -> bool:
+        # Marks the user's token as used; a token verifies only once
+        return await self.repo.redeem_pool_token(user_id, token)
+
+    def start(self, bot_username: str) -> None:
+        self.bot_username = bot_username
+        if self._task is None and self.target > 0:
+            self._task = asyncio.create_task(self._refill_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refill_loop(self) -> None:
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Token pool refill failed: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refill(self) -> None:
+        free = self.free_estimate = await self.repo.count_free_pool_tokens(self.bot_username)
+        if free >= self.low_watermark:
+            return
+        missing = self.target - free
+        logger.info(f"Refilling token pool with {missing} tokens")
+        semaphore = asyncio.Semaphore(TOKEN_POOL_CONCURRENCY)
+
+        async def make_one() -> bool:
+            async with semaphore:
+                token = os.urandom(16).hex()
+                link = verification_link(self.bot_username, token)
+                short_url = await self.shortener.shorten(link)
+                if short_url == link:
+                    # Shortener is failing; never pool an unshortened link
+                    return False
+                await self.repo.add_pool_token(self.bot_username, token, short_url)
+                return True
+
+        results = await asyncio.gather(*(make_one() for _ in range(missing)))
+        self.free_estimate += sum(results)
+        if not all(results):
+            logger.warning(f"Token pool refill added {sum(results)} of {missing} tokens")
+
+
+token_pool = TokenPool(repo, shortener)
@@ -0,0 +1,59 @@
+import os
+import logging
+from typing import Any, Callable, Dict, List
+
+from cache import TTLCache
+from database import repo
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 50000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 600))
+
+
+class UserStateCache:
+    # Caches a user's live sessions (verified_until, premium_until) per
+    # user_id. Every grant goes through update() so the cache never serves
+    # state older than our own writes. A user with no session is cached as
+    # an empty dict; an expired entry is still compared against the clock.
+
+    def __init__(self, repo, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL) -> None:
+        self.repo = repo
+        self.cache = TTLCache(maxsize, ttl)
+        # Bumped on every write so a load that raced with a write is not cached
+        self._version = 0
+        # Called with the user_ids of every local write (cross-worker invalidation)
+        self.listeners: List[Callable[[List[int]], None]] = []
+
+    async def get(self, user_id: int) -> Dict[str, Any]:
+        state = self.cache.get(user_id)
+        if state is not None:
+            return state
+        version = self._version
+        state = await self.repo.get_user_state(user_id)
+        if version == self._version:
+            self.cache.set(user_id, state)
+        return state
+
+    def update(self, user_id: int, **fields: Any) -> None:
+        self._version += 1
+        self._notify([user_id])
+        state = self.cache.peek(user_id)
+        if state is not None:
+            self.cache.set(user_id, {**state, **fields})
+
+    def invalidate(self, user_id: int, publish: bool = True) -> None:
+        self._version += 1
+        self.cache.pop(user_id)
+        if publish:
+            self._notify([user_id])
+
+    def _notify(self, user_ids: List[int]) -> None:
+        for listener in self.listeners:
+            listener(user_ids)
+
+    def stats(self) -> Dict[str, int]:
+        return self.cache.stats()
+
+
+user_state = UserStateCache(repo)
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from typing import List, Tuple
+
+import tornado.web
+from telegram.ext import Application
+
+from health import health
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(registry.render())
+
+
+class HealthzHandler(tornado.web.RequestHandler):
+    # Liveness: answering at all means the event loop is running
+    def get(self) -> None:
+        self.write({"status": "ok"})
+
+
+class ReadyzHandler(tornado.web.RequestHandler):
+    async def get(self) -> None:
+        ready, report = await health.report()
+        self.set_status(200 if ready else 503)
+        self.write(report)
+
+
+# Extra routes served on the webhook port, next to the Telegram webhook path
+ROUTES: List[Tuple[str, type]] = [
+    (r"/metrics", MetricsHandler),
+    (r"/healthz", HealthzHandler),
+    (r"/readyz", ReadyzHandler),
+]
+
+
+_attach_task = None
+
+
+def attach_routes(app: Application) -> None:
+    # Call from post_init; the routes are added once the webhook server is up
+    global _attach_task
+    _attach_task = asyncio.create_task(_attach_routes(app))
+
+
+async def _attach_routes(app: Application, timeout: float = 60) -> None:
+    # run_webhook builds its tornado application internally and PTB has no
+    # public hook for extra routes, so wait until the webhook server is up
+    # and add ours to it.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not (app.updater and app.updater.running):
+        if loop.time() > deadline:
+            logger.error("Webhook server did not start, extra routes not attached")
+            return
+        await asyncio.sleep(0.05)
+    try:
+        webhook_app = app.updater._httpd._http_server.request_callback
+        webhook_app.add_handlers(r".*", ROUTES)
+        logger.info(f"Serving {', '.join(path for path, _ in ROUTES)} on the webhook port")
+    except AttributeError as e:
+        logger.error(f"Could not attach extra routes to the webhook server: {e}")
@@ -0,0 +1,161 @@
+import os
+import socket
+import asyncio
+import logging
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+from telegram import Update
+
+from metrics import Counter, registry, wrap_handlers
+
+logger = logging.getLogger(__name__)
+
+# Run several replicas of the bot behind a load balancer. Every replica must
+# point at the same MongoDB and set MULTI_WORKER=true; WORKER_ID defaults to
+# host and pid. Locally, e.g.:
+#   MULTI_WORKER=true WORKER_ID=a PORT=8081 python main.py
+#   MULTI_WORKER=true WORKER_ID=b PORT=8082 python main.py
+# `python benchmark.py --workers 2 --mongo-uri ...` checks duplicate
+# dropping and cache invalidation with two such processes.
+MULTI_WORKER = os.getenv('MULTI_WORKER', 'false').lower() == 'true'
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+CACHE_EVENTS_SIZE = int(os.getenv('CACHE_EVENTS_SIZE', 16 * 1024 * 1024))  # bytes
+
+DUPLICATES = registry.register(Counter("bot_duplicate_updates_total", "Updates already claimed by a worker."))
+INVALIDATIONS = registry.register(Counter("bot_cache_invalidations_total",
+                                          "Cached keys dropped because another worker changed them.", ["cache"]))
+
+
+class UpdateClaims:
+    # Telegram may deliver the same update more than once (retries, or two
+    # replicas behind the load balancer). Each update_id is claimed with an
+    # insert into update_claims (unique _id, TTL index) before any handler
+    # runs, and an update someone else already claimed is dropped.
+
+    def __init__(self, repo, worker_id: str = WORKER_ID) -> None:
+        self.repo = repo
+        self.worker_id = worker_id
+
+    def dedupe(self, callback):
+        async def wrapper(update, context):
+            if isinstance(update, Update):
+                if not await self.repo.claim_update(update.update_id, self.worker_id):
+                    DUPLICATES.inc()
+                    logger.info(f"Dropping duplicate update {update.update_id}")
+                    return None
+            return await callback(update, context)
+        return wrapper
+
+    def dedupe_handlers(self, app) -> None:
+        wrap_handlers(app, self.dedupe)
+
+
+class CacheBus:
+    # Cross-worker cache invalidation. Workers append {cache, keys} events to a
+    # capped collection and tail it with a tailable cursor, dropping keys that
+    # other workers changed. Capped collections keep insertion order and work
+    # on a standalone mongod, unlike change streams.
+
+    def __init__(self, repo, worker_id: str = WORKER_ID) -> None:
+        self.repo = repo
+        self.worker_id = worker_id
+        self._subscribers: Dict[str, Callable[[Any], None]] = {}
+        self._pending: Set[asyncio.Task] = set()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, cache: str, invalidate: Callable[[Any], None]) -> None:
+        self._subscribers[cache] = invalidate
+
+    def publish(self, cache: str, keys: List[Any]) -> None:
+        # One event per batch of keys. Fire and forget, the writer does not
+        # wait for other workers.
+        task = asyncio.ensure_future(self.repo.publish_cache_event(cache, keys, self.worker_id))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        try:
+            await self.repo._run(self.repo.db.create_collection, 'cache_events', capped=True, size=CACHE_EVENTS_SIZE)
+        except CollectionInvalid:
+            pass
+        self._thread = threading.Thread(target=self._tail, name='cache-bus', daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def _tail(self) -> None:
+        # Resumes in natural (insertion) order after the last event seen.
+        # Timestamps and ObjectIds come from each publisher's clock, so
+        # neither is a safe resume point across workers.
+        collection = self.repo.db['cache_events']
+        last_id = self._last_event_id(collection)
+        while not self._stopped.is_set():
+            try:
+                if last_id is not None and collection.find_one({"_id": last_id}, {"_id": 1}) is None:
+                    # Overwritten by the capped collection; what came between is lost
+                    logger.warning("Cache bus fell behind, resuming from the newest event")
+                    last_id = self._last_event_id(collection)
+                skipping = last_id is not None
+                cursor = collection.find(cursor_type=CursorType.TAILABLE_AWAIT, max_await_time_ms=1000)
+                while cursor.alive and not self._stopped.is_set():
+                    for event in cursor:
+                        if skipping:
+                            skipping = event["_id"] != last_id
+                            continue
+                        last_id = event["_id"]
+                        if event.get("worker_id") != self.worker_id:
+                            self._dispatch(event)
+            except PyMongoError as e:
+                logger.error(f"Cache bus cursor failed: {e}")
+            # Cursor died (e.g. empty collection), wait before reopening
+            self._stopped.wait(1)
+
+    def _last_event_id(self, collection) -> Any:
+        event = collection.find_one(sort=[("$natural", -1)], projection={"_id": 1})
+        return event["_id"] if event else None
+
+    def _dispatch(self, event: Dict[str, Any]) -> None:
+        invalidate = self._subscribers.get(event.get("cache"))
+        if invalidate is not None:
+            keys = event.get("keys", [])
+            for key in keys:
+                self._loop.call_soon_threadsafe(invalidate, key)
+            # Counted on the loop too, /metrics reads the counter there
+            self._loop.call_soon_threadsafe(partial(INVALIDATIONS.inc, len(keys), cache=event["cache"]))
+
+
+cache_bus: Optional[CacheBus] = None
+
+
+def attach_workers(app, repo, caches: List) -> None:
+    # Sets up multi-worker mode on a built application. caches are
+    # (name, cache) pairs; a cache needs invalidate(key, publish=False) and
+    # a listeners list that is called with a list of the keys it changes.
+    global cache_bus
+    if not MULTI_WORKER:
+        return
+    UpdateClaims(repo).dedupe_handlers(app)
+    cache_bus = CacheBus(repo)
+    for name, cache in caches:
+        cache_bus.subscribe(name, lambda key, cache=cache: cache.invalidate(key, publish=False))
+        cache.listeners.append(lambda keys, name=name: cache_bus.publish(name, keys))
+
+
+async def start_workers() -> None:
+    if cache_bus is not None:
+        await cache_bus.start()
+
+
+async def stop_workers() -> None:
+    if cache_bus is not None:
+        await cache_bus.stop()